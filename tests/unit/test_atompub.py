@@ -1,8 +1,10 @@
 import functools
+import time
 import unittest
 import uuid
 
 import httplib2
+import mock
 import mox
 import stubout
 
@@ -205,3 +207,26 @@ class AtomPubTests(unittest.TestCase):
         self.handler.handle_messages(messages, dict())
         self.mox.VerifyAll()
         self.assertEqual(self.called, True)
+
+    def test_concurrent_delivery_notes_every_result(self):
+        messages = [MockMessage({'event_type': 'instance_create',
+                                 'message_id': n,
+                                 'content': dict(a=3)})
+                    for n in range(4)]
+        content = ("""<atom:entry xmlns:atom="http://www.w3.org/2005/Atom">"""
+        """<atom:id>urn:uuid:95347e4d-4737-4438-b774-6a9219d78d2a</atom:id>"""
+        """</atom:entry>""")
+
+        def mock_request(*args, **kwargs):
+            time.sleep(0.1)
+            return MockResponse(201), content
+
+        self.stubs.Set(httplib2.Http, 'request', mock_request)
+        env = dict()
+        with mock.patch.dict(AtomPubTests.config_dict['atompub'],
+                             max_in_flight='4'):
+            start = time.time()
+            self.handler.handle_messages(messages, env)
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEqual(sorted(env['atompub.results']), range(4))
+        self.assertTrue(all(m.acknowledged for m in messages))
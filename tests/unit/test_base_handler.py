@@ -3,6 +3,8 @@ import unittest
 import mox
 import stubout
 import yagi
+import yagi.handler
+import yagi.stats
 from yagi.handler import cuf_pub_handler, atompub_handler
 from yagi.handler.cuf_pub_handler import CufPub
 
@@ -277,3 +279,86 @@ class BaseHandlerTests(unittest.TestCase):
         atom_pub(messages, dict())
         self.mox.VerifyAll()
 
+
+
+class HandlerStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stats = []
+        self.stubs.Set(yagi.stats, 'time_stat',
+                       lambda metric, value: self.stats.append(metric))
+        self.stubs.Set(yagi.stats, 'increment_stat',
+                       lambda metric, value=1: self.stats.append(
+                           (metric, value)))
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_records_counts_and_time(self):
+        handler = yagi.handler.NullHandler(queue_name='notifications.info')
+        self.stubs.Set(handler, 'filter_message', lambda m: m[:1])
+        self.stubs.Set(handler, 'handle_messages', lambda m, env: None)
+        env = handler([MockMessage({}), MockMessage({})], {})
+        stats = env['yagi.handler_stats']['nullhandler']
+        self.assertEqual((stats['messages_in'], stats['messages_out'],
+                          stats['errors']), (2, 1, 0))
+        prefix = yagi.stats.handler_stat('nullhandler', 'notifications.info',
+                                         '')
+        self.assertEqual(self.stats, [prefix + 'elapsed',
+                                      (prefix + 'messages_in', 2),
+                                      (prefix + 'messages_out', 1)])
+
+    def test_counts_exceptions(self):
+        handler = yagi.handler.NullHandler()
+
+        def handle_messages(messages, env):
+            raise ValueError("boom")
+
+        self.stubs.Set(handler, 'filter_message', lambda m: m)
+        self.stubs.Set(handler, 'handle_messages', handle_messages)
+        env = {}
+        self.assertRaises(ValueError, handler, [MockMessage({})], env)
+        self.assertEqual(env['yagi.handler_stats']['nullhandler']['errors'],
+                         1)
+
+
+class HandlerSettingsTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.config = {
+            ('atompub:notifications.info', 'retries'): '3',
+            ('atompub', 'retries'): '5',
+            ('atompub', 'interval'): '30',
+            ('atompub', 'validate_ssl'): 'False',
+            ('atompub', 'provides'): 'a, b',
+        }
+        self.lookups = []
+
+        def get(section, key, default=None):
+            self.lookups.append((section, key))
+            return self.config.get((section, key), default)
+
+        self.stubs.Set(yagi.config, 'get', get)
+        self.stubs.Set(yagi.config, 'generation', object())
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_queue_section_wins(self):
+        handler = atompub_handler.AtomPub(queue_name='notifications.info')
+        self.assertEqual(handler.config_getint('retries'), 3)
+        self.assertEqual(handler.config_getint('interval'), 30)
+        self.assertEqual(handler.config_getbool('validate_ssl'), False)
+        self.assertEqual(handler.config_get('missing', default='x'), 'x')
+        self.assertEqual(handler.provides(), ['a', 'b'])
+        handler = atompub_handler.AtomPub()
+        self.assertEqual(handler.config_getint('retries'), 5)
+
+    def test_values_cached_per_generation(self):
+        handler = atompub_handler.AtomPub()
+        handler.config_getint('retries')
+        handler.config_getint('retries')
+        self.assertEqual(self.lookups, [('atompub', 'retries')])
+        self.config[('atompub', 'retries')] = '7'
+        self.stubs.Set(yagi.config, 'generation', object())
+        self.assertEqual(handler.config_getint('retries'), 7)
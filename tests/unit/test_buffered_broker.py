@@ -0,0 +1,97 @@
+import datetime
+import unittest
+
+import mock
+
+from yagi.broker import buffered
+from yagi.broker.message import LazyMessage
+
+
+def fetched(*names):
+    return [LazyMessage(mock.MagicMock(name=name)) for name in names]
+
+
+class FakeConsumer(object):
+    def __init__(self, queue_name='notifications.info', max_messages=2):
+        self.queue_name = queue_name
+        self.max_messages = max_messages
+        self.max_batch_latency = 0
+        self.connect_time = datetime.datetime.now()
+        self.consumer = mock.MagicMock()
+        self.ack_finished = mock.MagicMock()
+        self.refresh_config = mock.MagicMock()
+
+    def config(self, key, default=None):
+        return {'high_watermark': '4', 'low_watermark': '2'}.get(key,
+                                                                 default)
+
+
+class HandoffQueueTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('yagi.stats.gauge_stat')
+        self.gauge_stat = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pauses_between_watermarks(self):
+        handoff = buffered.HandoffQueue('q', 4, 2)
+        handoff.put(fetched('a', 'b', 'c', 'd'))
+        self.assertFalse(handoff.accepting())
+        batch = handoff.get(timeout=0)
+        handoff.done(batch[:1])
+        self.assertFalse(handoff.accepting())
+        handoff.done(batch[1:3])
+        self.assertTrue(handoff.accepting())
+        self.assertEqual(self.gauge_stat.call_args[0][1], 1)
+
+    def test_acks_are_sent_on_settle(self):
+        handoff = buffered.HandoffQueue('q', 4, 2)
+        handoff.put(fetched('a', 'b'))
+        batch = handoff.get(timeout=0)
+        batch[0].ack()
+        batch[1].requeue()
+        self.assertTrue(batch[0].acknowledged)
+        self.assertFalse(batch[0].message.ack.called)
+        handoff.settle()
+        self.assertTrue(batch[0].message.ack.called)
+        self.assertTrue(batch[1].message.requeue.called)
+
+    def test_clear_drops_unstarted_batches(self):
+        handoff = buffered.HandoffQueue('q', 4, 2)
+        handoff.put(fetched('a', 'b'))
+        handoff.clear()
+        self.assertTrue(handoff.idle())
+        self.assertEqual(handoff.get(timeout=0), None)
+
+
+class BufferedBrokerTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('yagi.stats.gauge_stat')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stops_fetching_when_handlers_fall_behind(self):
+        consumer = FakeConsumer()
+        broker = buffered.BufferedBroker()
+        broker.next_batch = mock.MagicMock(side_effect=[
+                fetched('a', 'b'), fetched('c', 'd'), fetched('e')])
+        self.assertEqual(broker.process_consumer(consumer, 0), 2)
+        self.assertEqual(broker.process_consumer(consumer, 0), 2)
+        self.assertEqual(broker.process_consumer(consumer, 0), 0)
+        self.assertEqual(broker.next_batch.call_count, 2)
+        self.assertEqual(broker.get_handoff(consumer).depth, 4)
+
+    def test_drains_before_reconnecting(self):
+        consumer = FakeConsumer()
+        consumer.connect_time = datetime.datetime(2000, 1, 1)
+        broker = buffered.BufferedBroker()
+        broker.establish_consumer_connection = mock.MagicMock()
+        handoff = broker.get_handoff(consumer)
+        handoff.put(fetched('a'))
+        broker.check_connection_age(consumer, 10)
+        self.assertFalse(handoff.accepting())
+        broker.check_connection_age(consumer, 10)
+        self.assertFalse(broker.establish_consumer_connection.called)
+        handoff.done(handoff.get(timeout=0))
+        broker.check_connection_age(consumer, 10)
+        broker.establish_consumer_connection.assert_called_once_with(
+                                                                consumer)
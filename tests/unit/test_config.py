@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+
+import yagi.config
+
+
+class ReloadTests(unittest.TestCase):
+    def setUp(self):
+        saved = (yagi.config.config, yagi.config.config_path,
+                 yagi.config.generation)
+
+        def restore():
+            (yagi.config.config, yagi.config.config_path,
+             yagi.config.generation) = saved
+            yagi.config._reload_requested.clear()
+
+        self.addCleanup(restore)
+        fd, self.path = tempfile.mkstemp(suffix=".conf")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.write("[atompub]\nurl = http://one\n")
+        yagi.config.parse_conf(self.path)
+
+    def write(self, contents):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+
+    def test_reloads_only_when_requested(self):
+        generation = yagi.config.generation
+        self.write("[atompub]\nurl = http://two\n")
+        self.assertFalse(yagi.config.reload_if_requested())
+        self.assertEqual(yagi.config.get('atompub', 'url'), 'http://one')
+        yagi.config.request_reload()
+        self.assertTrue(yagi.config.reload_if_requested())
+        self.assertEqual(yagi.config.get('atompub', 'url'), 'http://two')
+        self.assertEqual(yagi.config.generation, generation + 1)
+        self.assertFalse(yagi.config.reload_if_requested())
+
+    def test_bad_config_keeps_current(self):
+        generation = yagi.config.generation
+        self.write("url = no section header\n")
+        yagi.config.request_reload()
+        self.assertFalse(yagi.config.reload_if_requested())
+        self.assertEqual(yagi.config.get('atompub', 'url'), 'http://one')
+        self.assertEqual(yagi.config.generation, generation)
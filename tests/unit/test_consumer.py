@@ -0,0 +1,259 @@
+import unittest
+
+import mock
+
+import yagi.config
+import yagi.handler
+import yagi.shutdown
+from yagi.broker.message import LazyMessage
+from yagi.consumer import BatchSizer
+from yagi.consumer import Consumer
+
+
+class BatchSizerTests(unittest.TestCase):
+    def test_starts_at_max_size(self):
+        sizer = BatchSizer(10, 100, 5)
+        self.assertEqual(sizer.size, 100)
+
+    def test_shrinks_when_batches_run_long(self):
+        sizer = BatchSizer(10, 100, 5)
+        # 0.2s per message -> 25 messages fit in the target time.
+        self.assertEqual(sizer.update(100, 20.0), 25)
+
+    def test_never_shrinks_below_min_size(self):
+        sizer = BatchSizer(10, 100, 5)
+        self.assertEqual(sizer.update(100, 600.0), 10)
+
+    def test_grows_when_full_batches_are_fast(self):
+        sizer = BatchSizer(10, 100, 5)
+        sizer.size = 20
+        # 0.1s per message -> 50 messages fit, move halfway there.
+        self.assertEqual(sizer.update(20, 2.0), 35)
+        self.assertEqual(sizer.update(35, 3.5), 42)
+
+    def test_never_grows_past_max_size(self):
+        sizer = BatchSizer(10, 100, 5)
+        sizer.size = 90
+        self.assertEqual(sizer.update(90, 0.09), 100)
+
+    def test_does_not_grow_on_partial_batches(self):
+        sizer = BatchSizer(10, 100, 5)
+        sizer.size = 20
+        self.assertEqual(sizer.update(5, 0.01), 20)
+
+    def test_empty_batch_keeps_size(self):
+        sizer = BatchSizer(10, 100, 5)
+        self.assertEqual(sizer.update(0, 0), 100)
+
+
+class FakeMessage(object):
+    def __init__(self, message_id, delivery_tag, backend=None):
+        self.payload = {'message_id': message_id,
+                        'event_type': 'compute.instance.exists'}
+        self.delivery_tag = delivery_tag
+        self.backend = backend
+        self._state = None
+
+    @property
+    def acknowledged(self):
+        return self._state is not None
+
+    def ack(self):
+        self._state = "ACK"
+
+    def reject(self):
+        self._state = "REJECTED"
+
+    def requeue(self):
+        self._state = "REQUEUED"
+
+
+def make_consumer(**config):
+    config.setdefault('apps', 'yagi.handler.NullHandler')
+    config.setdefault('max_messages', '10')
+
+    def config_with(section):
+        return lambda key, default=None: config.get(key, default)
+
+    with mock.patch.object(yagi.config, 'config_with', config_with):
+        return Consumer('notifications.info')
+
+
+class ConsumerTests(unittest.TestCase):
+    def make_consumer(self, **config):
+        return make_consumer(**config)
+
+    def test_auto_ack_by_handlers(self):
+        consumer = self.make_consumer()
+        messages = [FakeMessage('1', 1), FakeMessage('2', 2)]
+        with mock.patch.object(yagi.handler.NullHandler, 'filter_message',
+                               side_effect=lambda m: m):
+            consumer.fetched_messages(messages)
+        self.assertEqual([m._state for m in messages], ["ACK", "ACK"])
+
+    def test_batch_ack_uses_single_multiple_ack(self):
+        consumer = self.make_consumer(ack_policy='batch')
+        backend = mock.MagicMock()
+        messages = [FakeMessage(str(n), n, backend) for n in range(1, 4)]
+        consumer.app = mock.MagicMock()
+        consumer.fetched_messages(messages)
+        backend.channel.basic_ack.assert_called_once_with(3, multiple=True)
+        self.assertTrue(all(m._state == "ACK" for m in messages))
+
+    def test_batch_ack_rejects_failed_messages(self):
+        consumer = self.make_consumer(ack_policy='batch')
+        backend = mock.MagicMock()
+        messages = [FakeMessage(str(n), n, backend) for n in range(1, 4)]
+
+        def app(messages, env):
+            env['atompub.results'] = {'2': dict(error=True),
+                                      '3': dict(error=False)}
+
+        consumer.app = app
+        consumer.fetched_messages(messages)
+        self.assertEqual(messages[1]._state, "REJECTED")
+        backend.channel.basic_ack.assert_called_once_with(3, multiple=True)
+
+    def test_batch_ack_leaves_lazy_messages_undecoded(self):
+        consumer = self.make_consumer(ack_policy='batch')
+        raw = FakeMessage('1', 1, mock.MagicMock())
+        raw.content_type = 'application/json'
+        raw.body = '{"message_id": "1", "event_type": "a"}'
+        message = LazyMessage(raw)
+        consumer.ack_batch([message], {'atompub.results':
+                                       {'1': dict(error=True)}})
+        self.assertEqual(raw._state, "REJECTED")
+        self.assertTrue(message._payload is None)
+
+    def test_batch_ack_requeues_when_chain_fails(self):
+        consumer = self.make_consumer(ack_policy='batch')
+        messages = [FakeMessage('1', 1), FakeMessage('2', 2)]
+        consumer.app = mock.MagicMock(side_effect=Exception("boom"))
+        consumer.fetched_messages(messages)
+        self.assertEqual([m._state for m in messages],
+                         ["REQUEUED", "REQUEUED"])
+
+    def test_parallel_apps_use_batch_ack(self):
+        consumer = self.make_consumer(
+                parallel_apps='True',
+                apps='yagi.handler.NullHandler, yagi.handler.NullHandler')
+        self.assertTrue(consumer.batch_ack)
+        self.assertEqual([h.app for h in consumer.handlers], [None, None])
+        self.assertEqual(consumer.app.handlers, consumer.handlers)
+
+    def test_pipeline_acks_when_last_stage_finishes(self):
+        consumer = self.make_consumer(
+                pipeline='True',
+                apps='yagi.handler.NullHandler, yagi.handler.NullHandler')
+        messages = [FakeMessage('1', 1), FakeMessage('2', 2)]
+        with mock.patch.object(yagi.handler.NullHandler, 'filter_message',
+                               side_effect=lambda m: m):
+            consumer.fetched_messages(messages)
+            consumer.wait_finished()
+        self.assertEqual([m._state for m in messages], ["ACK", "ACK"])
+
+    def test_shutdown_requeues_interrupted_batch(self):
+        consumer = self.make_consumer(ack_policy='batch')
+        messages = [FakeMessage('1', 1)]
+        consumer.app = mock.MagicMock(
+                side_effect=yagi.shutdown.ShutdownRequested("deadline"))
+        consumer.fetched_messages(messages)
+        self.assertEqual(messages[0]._state, "REQUEUED")
+
+    def test_dedup_drops_redelivered_messages(self):
+        consumer = self.make_consumer(ack_policy='batch', dedup='True',
+                                      size='100', store='')
+        consumer.app = mock.MagicMock()
+        consumer.fetched_messages([FakeMessage('1', 1), FakeMessage('2', 2)])
+        redelivered = [FakeMessage('2', 3), FakeMessage('3', 4)]
+        consumer.fetched_messages(redelivered)
+        self.assertEqual(consumer.app.call_args[0][0], [redelivered[1]])
+        self.assertEqual([m._state for m in redelivered], ["ACK", "ACK"])
+
+    def test_dedup_acks_duplicates_one_by_one(self):
+        consumer = self.make_consumer(dedup='True', size='100', store='')
+        consumer.dedup_cache.add(['3', '5'])
+        backend = mock.MagicMock()
+        messages = [FakeMessage(str(n), n, backend) for n in (3, 4, 5)]
+        fresh = consumer.drop_duplicates(messages)
+        self.assertEqual(fresh, [messages[1]])
+        self.assertEqual([m._state for m in messages], ["ACK", None, "ACK"])
+        self.assertFalse(backend.channel.basic_ack.called)
+
+    def test_multiple_ack_only_for_outstanding_prefix(self):
+        consumer = self.make_consumer()
+        backend = mock.MagicMock()
+        messages = [FakeMessage(str(n), n, backend) for n in range(1, 6)]
+        # Tag 1 is still out, so acking 2 and 3 has to go one by one.
+        consumer.ack_messages(messages[1:3])
+        self.assertFalse(backend.channel.basic_ack.called)
+        self.assertEqual([m._state for m in messages[1:3]], ["ACK", "ACK"])
+        consumer.ack_messages([messages[0], messages[3]])
+        backend.channel.basic_ack.assert_called_once_with(4, multiple=True)
+
+    def test_dedup_skips_failed_messages(self):
+        consumer = self.make_consumer(ack_policy='batch', dedup='True',
+                                      size='100', store='')
+
+        def app(messages, env):
+            env['atompub.results'] = {'1': dict(error=True)}
+
+        consumer.app = app
+        consumer.fetched_messages([FakeMessage('1', 1)])
+        self.assertEqual(consumer.dedup_cache.seen(['1']), set())
+
+    def test_refresh_config_after_reload(self):
+        consumer = self.make_consumer()
+        config = {'max_messages': '20', 'max_batch_latency_ms': '500'}
+        consumer.config = lambda key, default=None: config.get(key, default)
+        consumer.refresh_config()
+        self.assertEqual(consumer.max_messages, 10)
+        with mock.patch.object(yagi.config, 'generation', object()):
+            consumer.refresh_config()
+        self.assertEqual(consumer.max_messages, 20)
+        self.assertEqual(consumer.max_batch_latency, 0.5)
+
+
+class BindingTests(unittest.TestCase):
+    def setUp(self):
+        self.filters = {('filters', 'null'): 'a, b',
+                        ('exclude_filters', 'null'): 'b',
+                        ('filters', 'atompub'): 'c'}
+        patcher = mock.patch.object(yagi.config, 'get',
+                    side_effect=lambda s, k, **kw: self.filters.get((s, k)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_consumer(self, **config):
+        config.setdefault('apps', 'yagi.handler.NullHandler, '
+                                  'yagi.handler.atompub_handler.AtomPub')
+        config.setdefault('max_messages', '10')
+        config.setdefault('routing_key', 'notifications.info')
+        return make_consumer(**config)
+
+    def test_no_bindings_by_default(self):
+        self.assertEqual(self.make_consumer().bindings(), None)
+
+    def test_routing_key_bindings(self):
+        consumer = self.make_consumer(
+                filter_bindings='routing_key',
+                filter_routing_key='%(routing_key)s.%(event_type)s')
+        self.assertEqual(consumer.bindings(),
+                         [('notifications.info.a', None),
+                          ('notifications.info.c', None)])
+
+    def test_headers_bindings(self):
+        consumer = self.make_consumer(filter_bindings='headers')
+        self.assertEqual(consumer.bindings(),
+                 [('', {'x-match': 'all', 'event_type': 'a'}),
+                  ('', {'x-match': 'all', 'event_type': 'c'})])
+
+    def test_glob_filter_keeps_routing_key(self):
+        self.filters[('filters', 'atompub')] = 'compute.instance.*'
+        consumer = self.make_consumer(filter_bindings='routing_key')
+        self.assertEqual(consumer.bindings(), None)
+
+    def test_unfiltered_handler_keeps_routing_key(self):
+        del self.filters[('filters', 'atompub')]
+        consumer = self.make_consumer(filter_bindings='routing_key')
+        self.assertEqual(consumer.bindings(), None)
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import yagi.config
+from yagi import dedup
+
+
+class DedupCacheTests(unittest.TestCase):
+    def test_remembers_added_ids(self):
+        cache = dedup.DedupCache(10)
+        cache.add(['a', 'b'])
+        self.assertEqual(cache.seen(['a', 'c']), set(['a']))
+
+    def test_evicts_least_recently_used(self):
+        cache = dedup.DedupCache(2)
+        cache.add(['a', 'b'])
+        cache.seen(['a'])
+        cache.add(['c'])
+        self.assertEqual(cache.seen(['a', 'b', 'c']), set(['a', 'c']))
+
+    def test_asks_store_about_misses(self):
+        store = mock.MagicMock()
+        store.recent.return_value = ['a']
+        store.seen.return_value = set(['b'])
+        cache = dedup.DedupCache(10, store)
+        self.assertEqual(cache.seen(['a', 'b', 'c']), set(['a', 'b']))
+        store.seen.assert_called_once_with(['b', 'c'])
+
+    def test_store_errors_are_not_fatal(self):
+        store = mock.MagicMock()
+        store.recent.return_value = []
+        store.seen.side_effect = Exception("redis went away")
+        store.add.side_effect = Exception("redis went away")
+        cache = dedup.DedupCache(10, store)
+        cache.add(['a'])
+        self.assertEqual(cache.seen(['a', 'b']), set(['a']))
+
+
+class RedisStoreTests(unittest.TestCase):
+    def test_ids_expire_after_ttl(self):
+        redis = mock.MagicMock()
+        config = {'ttl': '3600', 'port': '6379'}
+
+        def config_with(section):
+            return lambda key, default=None: config.get(key, default)
+
+        with mock.patch.dict('sys.modules', redis=redis):
+            with mock.patch.object(yagi.config, 'config_with', config_with):
+                store = dedup.RedisStore('q', 10)
+        store.add(['a'])
+        pipe = redis.Redis.return_value.pipeline.return_value
+        pipe.set.assert_called_once_with('dedup:q:a', 1, ex=3600)
+
+
+class FileStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        patcher = mock.patch.object(yagi.config, 'get',
+                                    return_value=self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_survives_restart(self):
+        dedup.DedupCache(10, dedup.FileStore('q', 10)).add(['a', 'b'])
+        cache = dedup.DedupCache(10, dedup.FileStore('q', 10))
+        self.assertEqual(cache.seen(['a', 'b', 'c']), set(['a', 'b']))
+
+    def test_compacts_file(self):
+        store = dedup.FileStore('q', 2)
+        store.add(['a', 'b', 'c', 'd'])
+        with open(os.path.join(self.path, 'q')) as f:
+            self.assertEqual(f.read(), 'c\nd\n')
@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+
+from yagi.handler import delivery
+
+
+class FakeMessage(object):
+    def __init__(self, message_id, instance_id=None):
+        self.message_id = message_id
+        self.payload = {'message_id': message_id}
+        if instance_id is not None:
+            self.payload['payload'] = {'instance_id': instance_id}
+
+
+class DeliveryTests(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.done = []
+        self.done_threads = set()
+
+    def send(self, message):
+        time.sleep(0.05)
+        self.sent.append(message.message_id)
+
+    def on_done(self, message):
+        self.done.append(message.message_id)
+        self.done_threads.add(threading.current_thread().name)
+
+    def test_sends_concurrently(self):
+        deliver = delivery.Delivery(self.send, 10, done=self.on_done)
+        messages = [FakeMessage(n) for n in range(10)]
+        start = time.time()
+        deliver(messages)
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(sorted(self.sent), range(10))
+        self.assertEqual(sorted(self.done), range(10))
+        self.assertEqual(self.done_threads,
+                         set([threading.current_thread().name]))
+
+    def test_lanes_keep_order(self):
+        deliver = delivery.Delivery(self.send, 4,
+                                    lane=delivery.instance_lane)
+        messages = [FakeMessage(n, instance_id=n % 2) for n in range(6)]
+        deliver(messages)
+        self.assertEqual([n for n in self.sent if n % 2 == 0], [0, 2, 4])
+        self.assertEqual([n for n in self.sent if n % 2 == 1], [1, 3, 5])
+
+    def test_error_stops_delivery_and_is_raised(self):
+        def send(message):
+            if message.message_id == 0:
+                raise ValueError("boom")
+            self.send(message)
+
+        deliver = delivery.Delivery(send, 2, lane=lambda m: 'same',
+                                    done=self.on_done)
+        self.assertRaises(ValueError, deliver,
+                          [FakeMessage(n) for n in range(3)])
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.done, [])
+
+    def test_limit_of_one_sends_in_order(self):
+        deliver = delivery.Delivery(self.send, 1, done=self.on_done)
+        deliver([FakeMessage(n) for n in range(3)])
+        self.assertEqual(self.done, [0, 1, 2])
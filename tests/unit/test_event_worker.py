@@ -0,0 +1,65 @@
+import unittest
+
+import mock
+
+import yagi.config
+from yagi import event_worker
+
+
+class FakeConsumer(object):
+    def __init__(self, queue_name, processes=None):
+        self.queue_name = queue_name
+        self.processes = processes
+
+    def config(self, key, default=None):
+        if key == 'processes' and self.processes is not None:
+            return self.processes
+        return default
+
+
+class WorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.config = {'processes': '1', 'restart_delay': '5',
+                       'shutdown_timeout': '0'}
+        patcher = mock.patch.object(yagi.config, 'get',
+                side_effect=lambda s, k, **kw: self.config.get(k))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(event_worker.multiprocessing, 'Process')
+        self.process_cls = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_processes_per_queue(self):
+        pool = event_worker.WorkerPool([FakeConsumer('a', processes='3'),
+                                        FakeConsumer('b')])
+        pool.check_workers()
+        names = [c[1]['name'] for c in self.process_cls.call_args_list]
+        self.assertEqual(names, ['yagi-a-0', 'yagi-a-1', 'yagi-a-2',
+                                 'yagi-b-0'])
+
+    def test_restarts_dead_worker_after_delay(self):
+        pool = event_worker.WorkerPool([FakeConsumer('a')])
+        pool.check_workers()
+        process = self.process_cls.return_value
+        process.is_alive.return_value = False
+        pool.check_workers()
+        self.assertEqual(self.process_cls.call_count, 1)
+        pool.slots[0]['died'] -= 5
+        pool.check_workers()
+        self.assertEqual(self.process_cls.call_count, 2)
+
+    def test_take_messages_sent(self):
+        pool = event_worker.WorkerPool([FakeConsumer('a'),
+                                        FakeConsumer('b')])
+        pool.counters['a'].value += 7
+        self.assertEqual(pool.take_messages_sent(), {'a': 7, 'b': 0})
+        self.assertEqual(pool.take_messages_sent(), {'a': 0, 'b': 0})
+
+    def test_shutdown_terminates_workers(self):
+        pool = event_worker.WorkerPool([FakeConsumer('a')])
+        pool.check_workers()
+        process = self.process_cls.return_value
+        process.is_alive.side_effect = [True, False]
+        pool.shutdown()
+        self.assertTrue(process.terminate.called)
+        self.assertTrue(process.join.called)
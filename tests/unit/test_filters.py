@@ -0,0 +1,113 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+import dateutil.parser
+import mock
+
+import yagi.config
+import yagi.filters
+import yagi.stats
+
+
+class FilterTests(unittest.TestCase):
+    def setUp(self):
+        self.log = mock.Mock()
+        patcher = mock.patch.object(yagi.config, 'generation', object())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def map_file(self, mapping):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(mapping, f)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def get_filter(self, method, mapping):
+        return yagi.filters.get_filter(method, self.map_file(mapping),
+                                       self.log)
+
+    def test_replaces_nested_values(self):
+        f = self.get_filter('FilterMessage',
+                            {'payload': {'tenant_id': 'x', 'missing': 'y'},
+                             'publisher_id': 'z'})
+        message = f({'payload': {'tenant_id': '1234', 'host': 'h'},
+                     'publisher_id': 'compute.1',
+                     'other': 'o'})
+        self.assertEqual(message, {'payload': {'tenant_id': 'x',
+                                               'host': 'h'},
+                                   'publisher_id': 'z',
+                                   'other': 'o'})
+
+    def test_match_translates_values(self):
+        f = self.get_filter('FilterMessageMatch',
+                            {'payload': {
+                                'os_type': [{'linux': 'LINUX'},
+                                            {'linux': 'no', '7': 'seven'}],
+                                'state': {'active': 'ACTIVE'}}})
+        message = f({'payload': {'os_type': 'linux', 'state': 'active'}})
+        self.assertEqual(message['payload'],
+                         {'os_type': 'LINUX', 'state': 'ACTIVE'})
+        message = f({'payload': {'os_type': 7, 'state': 'deleted'}})
+        self.assertEqual(message['payload'],
+                         {'os_type': 'seven', 'state': 'deleted'})
+
+    def test_timestamp_offsets_hours(self):
+        f = self.get_filter('FilterMessageTimestamp',
+                            {'payload': {'launched_at': 2, 'bad': 1}})
+        message = f({'payload': {'launched_at': '2013-01-01 23:30:00',
+                                 'bad': 'not a time'}})
+        self.assertEqual(message['payload']['launched_at'],
+                         '2013-01-02 01:30:00.000000')
+        self.assertEqual(message['payload']['bad'], 'not a time')
+        self.assertTrue(self.log.exception.called)
+
+    def test_filter_is_shared(self):
+        map_file = self.map_file({'a': 'b'})
+        f = yagi.filters.get_filter('FilterMessage', map_file, self.log)
+        self.assertTrue(f is yagi.filters.get_filter('FilterMessage',
+                                                     map_file, self.log))
+        with mock.patch.object(yagi.config, 'generation', object()):
+            self.assertFalse(f is yagi.filters.get_filter('FilterMessage',
+                                                          map_file,
+                                                          self.log))
+
+    def test_unknown_filter(self):
+        self.assertEqual(yagi.filters.get_filter('Nope', 'x', self.log),
+                         None)
+
+    def test_timestamp_formats_match_dateutil(self):
+        f = self.get_filter('FilterMessageTimestampForUsageRetards',
+                            {'payload': {'audit_period_ending': -5}})
+        for timestamp in ['2013-01-01 03:30:00',
+                          '2013-01-01T03:30:00.123456',
+                          '2013-01-01T03:30:00.12Z',
+                          '2013-01-01 03:30:00.5+02:00',
+                          '2013-01-01']:
+            message = f({'payload': {'audit_period_ending': timestamp}})
+            expected = dateutil.parser.parse(timestamp) + \
+                       datetime.timedelta(hours=-5)
+            self.assertEqual(message['payload']['audit_period_ending'],
+                             expected.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+        self.assertEqual(f.fallbacks, 0)
+
+    def test_unknown_timestamp_format_falls_back(self):
+        f = self.get_filter('FilterMessageTimestamp',
+                            {'payload': {'launched_at': 1}})
+        with mock.patch.object(yagi.stats, 'increment_stat') as increment:
+            message = f({'payload': {'launched_at': 'Jan 1 2013 10:00'}})
+        self.assertEqual(message['payload']['launched_at'],
+                         '2013-01-01 11:00:00.000000')
+        self.assertEqual(f.fallbacks, 1)
+        increment.assert_called_once_with(yagi.stats.timestamp_fallbacks())
+
+    def test_timestamp_format_is_remembered_per_path(self):
+        f = self.get_filter('FilterMessageTimestamp',
+                            {'payload': {'a': 0, 'b': 0}})
+        f({'payload': {'a': '2013-01-01', 'b': '2013-01-01 10:00:00'}})
+        self.assertEqual(f.formats.keys(), [('payload', 'a')])
+        self.assertTrue(f.formats[('payload', 'a')][0] is
+                        yagi.filters.TIMESTAMP_FORMATS[1])
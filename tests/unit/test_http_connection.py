@@ -1,3 +1,5 @@
+import threading
+import time
 import unittest
 import httplib2
 import mox
@@ -5,6 +7,7 @@ from yagi import http_util
 from tests.unit.test_cufpub import MockMessage, MockResponse
 from yagi.handler.atompub_handler import UnauthorizedException, MessageDeliveryFailed
 from yagi.handler.cuf_pub_handler import CufPub
+from yagi.handler import http_connection
 from yagi.handler.http_connection import HttpConnection, InvalidContentException
 import functools
 import stubout
@@ -188,3 +191,99 @@ class HttpConnectionTests(unittest.TestCase):
 
 
 
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.created = []
+
+        def make_connection(handler, force=False):
+            connection = mox.MockAnything()
+            connection.generation = yagi.config.generation
+            connection.forced = force
+            connection.closed = False
+            connection.check = lambda: None
+
+            def close():
+                connection.closed = True
+
+            connection.close = close
+            self.created.append(connection)
+            return connection
+
+        self.stubs.Set(http_connection, 'HttpConnection', make_connection)
+        self.pool = http_connection.ConnectionPool(2, 60)
+        self.real_time = time.time
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_reuses_released_connections(self):
+        connection = self.pool.acquire(None)
+        self.pool.release(connection)
+        self.assertTrue(self.pool.acquire(None) is connection)
+        self.assertEqual(len(self.created), 1)
+
+    def test_failed_connections_are_closed(self):
+        connection = self.pool.acquire(None)
+        self.pool.release(connection, healthy=False)
+        self.assertTrue(connection.closed)
+        self.assertFalse(self.pool.acquire(None) is connection)
+
+    def test_idle_connections_expire(self):
+        connection = self.pool.acquire(None)
+        self.pool.release(connection)
+        self.stubs.Set(time, 'time', lambda: self.real_time() + 61)
+        self.assertFalse(self.pool.acquire(None) is connection)
+        self.assertTrue(connection.closed)
+
+    def test_forced_connection_flushes_pool(self):
+        idle = self.pool.acquire(None)
+        busy = self.pool.acquire(None)
+        self.pool.release(idle)
+        forced = self.pool.acquire(None, force=True)
+        self.assertTrue(forced.forced)
+        self.assertTrue(idle.closed)
+        self.pool.release(busy)
+        self.assertTrue(busy.closed)
+        self.pool.release(forced)
+        self.assertTrue(self.pool.acquire(None) is forced)
+
+    def test_keeps_at_most_size_idle(self):
+        connections = [self.pool.acquire(None) for n in range(3)]
+        for connection in connections:
+            self.pool.release(connection)
+        self.assertEqual([c.closed for c in connections],
+                         [False, False, True])
+
+    def test_max_in_flight_waits_for_a_release(self):
+        pool = http_connection.ConnectionPool(2, 60, max_in_flight=1)
+        first = pool.acquire(None)
+        acquired = []
+        thread = threading.Thread(
+                target=lambda: acquired.append(pool.acquire(None)))
+        thread.daemon = True
+        thread.start()
+        thread.join(0.2)
+        self.assertEqual(acquired, [])
+        pool.release(first)
+        thread.join(5)
+        self.assertEqual(acquired, [first])
+
+    def test_pool_settings_follow_config_reload(self):
+        handler = mox.MockAnything()
+        handler.CONFIG_SECTION = 'atompub'
+        # Per-queue overrides don't apply to a pool every queue shares.
+        handler.config_getint = lambda key, default=None: 9
+        config = {'atompub': {'pool_size': '3', 'max_in_flight': '2'}}
+        self.stubs.Set(yagi.config, 'get',
+                       lambda section, key: config[section].get(key))
+        self.addCleanup(http_connection.clear_pools)
+        pool = http_connection.get_pool(handler, 'http://feed')
+        self.assertEqual((pool.size, pool.max_in_flight), (3, 2))
+        config['atompub']['max_in_flight'] = '5'
+        self.stubs.Set(yagi.config, 'generation', object())
+        self.assertTrue(http_connection.get_pool(handler,
+                                                 'http://feed') is pool)
+        self.assertEqual(pool.max_in_flight, 5)
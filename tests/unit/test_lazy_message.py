@@ -0,0 +1,53 @@
+import unittest
+
+import mock
+
+from yagi.broker.message import LazyMessage
+
+
+def raw_message(body, content_type="application/json"):
+    message = mock.MagicMock()
+    message.body = body
+    message.content_type = content_type
+    message._state = "RECEIVED"
+    return message
+
+
+class LazyMessageTests(unittest.TestCase):
+    def test_event_type_does_not_decode_body(self):
+        message = LazyMessage(raw_message(
+                '{"event_type": "compute.instance.create.end", '
+                '"payload": {"state": "active"}}'))
+        self.assertEqual(message.event_type, "compute.instance.create.end")
+        self.assertEqual(message._payload, None)
+
+    def test_event_type_falls_back_when_ambiguous(self):
+        message = LazyMessage(raw_message(
+                '{"payload": {"event_type": "inner"}, '
+                '"event_type": "outer"}'))
+        self.assertEqual(message.event_type, "outer")
+
+    def test_payload_is_decoded_once(self):
+        raw = raw_message('{"event_type": "a", "payload": {"x": 1}}')
+        message = LazyMessage(raw)
+        self.assertEqual(message.payload['payload'], {"x": 1})
+        self.assertTrue(message.payload is message.payload)
+
+    def test_non_json_uses_message_payload(self):
+        raw = raw_message("raw", content_type="text/plain")
+        raw.payload = {"event_type": "b"}
+        self.assertEqual(LazyMessage(raw).event_type, "b")
+
+    def test_state_is_shared_with_wrapped_message(self):
+        raw = raw_message("{}")
+        message = LazyMessage(raw)
+        message._state = "ACK"
+        self.assertEqual(raw._state, "ACK")
+        message.ack()
+        self.assertTrue(raw.ack.called)
+
+    def test_message_id_does_not_decode_body(self):
+        message = LazyMessage(raw_message(
+                '{"message_id": "abc-123", "event_type": "a"}'))
+        self.assertEqual(message.message_id, "abc-123")
+        self.assertEqual(message._payload, None)
@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from shoebox import archive
+
+from yagi.broker import memory
+from yagi.broker import replay
+
+
+class FakeConsumer(object):
+    def __init__(self, queue_name='notifications.info', max_messages=2,
+                 config=None):
+        self.queue_name = queue_name
+        self.max_messages = max_messages
+        self.batches = []
+        self._config = config or {}
+        self.connect = mock.MagicMock()
+        self.idle = mock.MagicMock()
+        self.ack_finished = mock.MagicMock()
+        self.wait_finished = mock.MagicMock()
+
+    def config(self, key, default=None):
+        return self._config.get(key, default)
+
+    def fetched_messages(self, messages):
+        self.batches.append([m.payload for m in messages])
+        for message in messages:
+            message.ack()
+
+
+class MemoryBrokerTests(unittest.TestCase):
+    def test_loop_drains_sources_in_batches(self):
+        broker = memory.Broker()
+        broker.feed('notifications.info', [{'n': 1}, {'n': 2}, {'n': 3}])
+        consumer = FakeConsumer()
+        broker.add_consumer(consumer)
+        sent = broker.loop()
+        self.assertEqual(sent, {'notifications.info': 3})
+        self.assertEqual(consumer.batches, [[{'n': 1}, {'n': 2}],
+                                            [{'n': 3}]])
+        consumer.idle.assert_called_once_with(3, 'notifications.info')
+
+    def test_requeued_messages_are_delivered_again(self):
+        broker = memory.Broker()
+        broker.feed('notifications.info', [{'n': 1}, {'n': 2}])
+        consumer = FakeConsumer()
+        broker.add_consumer(consumer)
+        first = broker.fetch_messages(consumer, 1)[0]
+        first.requeue()
+        payloads = [m.payload for m in broker.fetch_messages(consumer, 5)]
+        self.assertEqual(payloads, [{'n': 1}, {'n': 2}])
+
+    def test_message_can_only_be_acknowledged_once(self):
+        message = memory.Message({})
+        self.assertFalse(message.acknowledged)
+        message.ack()
+        self.assertTrue(message.acknowledged)
+        self.assertRaises(memory.MessageStateError, message.reject)
+
+
+class ReplayBrokerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_replays_json_lines(self):
+        filename = os.path.join(self.directory, 'events.json')
+        with open(filename, 'w') as f:
+            f.write(json.dumps({'event_type': 'a'}) + '\n\n')
+            f.write(json.dumps({'region': 'r', 'cell': 'c',
+                                'notification': {'event_type': 'b'}}))
+        broker = replay.Broker()
+        consumer = FakeConsumer(config={'replay_path': filename})
+        broker.add_consumer(consumer)
+        broker.loop()
+        self.assertEqual(consumer.batches, [[{'event_type': 'a'},
+                                             {'event_type': 'b'}]])
+
+    def test_replays_shoebox_archive(self):
+        filename = os.path.join(self.directory, 'events.dat')
+        writer = archive.ArchiveWriter(filename)
+        for n in range(3):
+            writer.write({}, json.dumps({'event_type': 'e%d' % n}))
+        writer.close()
+        payloads = list(replay.read_file(filename))
+        self.assertEqual([p['event_type'] for p in payloads],
+                         ['e0', 'e1', 'e2'])
@@ -0,0 +1,91 @@
+import signal
+import threading
+import time
+import unittest
+
+from yagi.handler import parallel
+import yagi.shutdown
+
+
+class FakeHandler(object):
+    def __init__(self, name, requires=(), provides=None, run=None):
+        self.name = name
+        self._requires = list(requires)
+        self._provides = [name + '.results'] if provides is None else provides
+        self.run = run
+
+    def requires(self):
+        return self._requires
+
+    def provides(self):
+        return self._provides
+
+    def __call__(self, messages, env=None):
+        if self.run:
+            self.run(env)
+        env[self.name + '.results'] = dict((m, self.name) for m in messages)
+
+
+class ParallelChainTests(unittest.TestCase):
+    def test_levels_follow_dependencies(self):
+        atompub = FakeHandler('atompub')
+        cufpub = FakeHandler('cufpub')
+        ping = FakeHandler('ping', requires=['atompub.results'], provides=[])
+        es = FakeHandler('es', requires=['cufpub.results'], provides=[])
+        shoebox = FakeHandler('shoebox')
+        levels = parallel.build_levels([atompub, cufpub, ping, es, shoebox])
+        self.assertEqual(levels, [[atompub, cufpub, shoebox], [ping, es]])
+
+    def test_independent_handlers_run_concurrently(self):
+        started = threading.Event()
+
+        def first(env):
+            # Only returns if the second handler runs at the same time.
+            self.assertTrue(started.wait(5))
+
+        def second(env):
+            started.set()
+
+        def ping(env):
+            self.assertEqual(env['a.results'], {'m1': 'a'})
+            self.assertEqual(env['b.results'], {'m1': 'b'})
+
+        chain = parallel.ParallelChain([
+                FakeHandler('a', run=first), FakeHandler('b', run=second),
+                FakeHandler('ping', requires=['a.results', 'b.results'],
+                            run=ping)])
+        env = chain(['m1'])
+        self.assertEqual(env['ping.results'], {'m1': 'ping'})
+
+    def test_errors_raised_after_level_finishes(self):
+        def fail(env):
+            raise ValueError("boom")
+
+        chain = parallel.ParallelChain([FakeHandler('a', run=fail),
+                                        FakeHandler('b')])
+        env = {}
+        self.assertRaises(ValueError, chain, ['m1'], env)
+        self.assertEqual(env['b.results'], {'m1': 'b'})
+
+    def test_drain_deadline_interrupts_level(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def stuck(env):
+            release.wait(10)
+
+        chain = parallel.ParallelChain([FakeHandler('a', run=stuck),
+                                        FakeHandler('b')])
+        previous = signal.signal(signal.SIGALRM,
+                                 yagi.shutdown._deadline_passed)
+        self.addCleanup(signal.signal, signal.SIGALRM, previous)
+        self.addCleanup(signal.setitimer, signal.ITIMER_REAL, 0)
+        started = time.time()
+        signal.setitimer(signal.ITIMER_REAL, 0.2)
+        self.assertRaises(yagi.shutdown.ShutdownRequested, chain, ['m1'])
+        self.assertTrue(time.time() - started < 5)
+
+    def test_merge_env_combines_results(self):
+        env = {'cufpub.results': {'1': 'x'}}
+        parallel.merge_env(env, {'cufpub.results': {'2': 'y'}})
+        self.assertEqual(env['cufpub.results'], {'1': 'x', '2': 'y'})
@@ -0,0 +1,132 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from yagi.handler import pipeline
+
+
+class FakeHandler(object):
+    def __init__(self, name, run=None):
+        self.name = name
+        self.run = run
+        self.idle = mock.MagicMock()
+        self.shutdown = mock.MagicMock()
+
+    def __call__(self, messages, env=None):
+        if self.run:
+            self.run(messages)
+        env.setdefault('stages', []).append(self.name)
+
+
+class SlowDict(dict):
+    def __contains__(self, key):
+        found = dict.__contains__(self, key)
+        time.sleep(0.001)
+        return found
+
+
+def one_worker(handler):
+    return 1
+
+
+class PipelineTests(unittest.TestCase):
+    def wait(self, chain, count):
+        finished = []
+        while len(finished) < count:
+            finished.extend(chain.take_finished())
+            time.sleep(0.01)
+        return finished
+
+    def test_batches_pass_through_every_stage(self):
+        chain = pipeline.Pipeline([FakeHandler('a'), FakeHandler('b')],
+                                  one_worker, 2)
+        chain(['m1'], env={})
+        chain(['m2'], env={})
+        finished = self.wait(chain, 2)
+        self.assertEqual([(m, env['stages']) for m, env in finished],
+                         [(['m1'], ['a', 'b']), (['m2'], ['a', 'b'])])
+
+    def test_fast_stage_runs_ahead_of_slow_one(self):
+        release = threading.Event()
+        seen_by_a = []
+
+        def slow(messages):
+            release.wait(5)
+
+        chain = pipeline.Pipeline([FakeHandler('a', run=seen_by_a.extend),
+                                   FakeHandler('b', run=slow)],
+                                  one_worker, 5)
+        for n in range(3):
+            chain(['m%d' % n], env={})
+        while len(seen_by_a) < 3:
+            time.sleep(0.01)
+        self.assertTrue(chain.busy())
+        release.set()
+        self.assertEqual(len(self.wait(chain, 3)), 3)
+        self.assertFalse(chain.busy())
+
+    def test_batches_finish_in_submission_order(self):
+        release = threading.Event()
+
+        def first_is_slow(messages):
+            if messages == ['m1']:
+                release.wait(5)
+
+        chain = pipeline.Pipeline([FakeHandler('a', run=first_is_slow)],
+                                  lambda handler: 2, 2)
+        chain(['m1'], env={})
+        chain(['m2'], env={})
+        while chain.stages[0].input.unfinished_tasks > 1:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEqual(chain.take_finished(), [])
+        release.set()
+        self.assertEqual([m for m, env in self.wait(chain, 2)],
+                         [['m1'], ['m2']])
+
+    def test_take_finished_from_two_threads(self):
+        chain = pipeline.Pipeline([FakeHandler('a')], lambda handler: 4, 10)
+        # Gives the other thread a chance to get in between checking for
+        # the next batch and taking it.
+        chain.held = SlowDict()
+        taken = []
+        errors = []
+
+        def take():
+            try:
+                while len(taken) < 200:
+                    taken.extend(m[0] for m, env in chain.take_finished())
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=take) for n in range(2)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for n in range(200):
+            chain([n], env={})
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(taken), range(200))
+
+    def test_error_skips_later_stages(self):
+        def fail(messages):
+            raise ValueError("boom")
+
+        chain = pipeline.Pipeline([FakeHandler('a', run=fail),
+                                   FakeHandler('b')], one_worker, 2)
+        chain(['m1'], env={})
+        messages, env = self.wait(chain, 1)[0]
+        self.assertTrue(isinstance(env['yagi.pipeline_error'], ValueError))
+        self.assertFalse('stages' in env)
+
+    def test_idle_reaches_every_stage(self):
+        a, b = FakeHandler('a'), FakeHandler('b')
+        chain = pipeline.Pipeline([a, b], one_worker, 2)
+        chain.idle(5, 'q')
+        chain.shutdown()
+        b.idle.assert_called_once_with(5, 'q')
+        a.shutdown.assert_called_once_with()
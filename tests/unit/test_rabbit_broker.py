@@ -0,0 +1,325 @@
+import datetime
+import socket
+import threading
+import unittest
+
+import mock
+
+from yagi.broker import rabbit
+import yagi.shutdown
+
+
+def unwrap(messages):
+    return [m.message for m in messages]
+
+
+class FakeConsumer(object):
+    def __init__(self, queue_name='notifications.info', max_messages=3):
+        self.queue_name = queue_name
+        self.max_messages = max_messages
+        self.max_batch_latency = 0
+        self.consumer = mock.MagicMock()
+        self.ack_finished = mock.MagicMock()
+        self.refresh_config = mock.MagicMock()
+        self.connection = mock.MagicMock()
+        self.fetched_messages = mock.MagicMock()
+
+    def bindings(self):
+        return None
+
+
+class BrokerTests(unittest.TestCase):
+    def setUp(self):
+        self.config = {'connection_age_jitter': '0.2'}
+        patcher = mock.patch.object(rabbit.conf, 'get',
+                          side_effect=lambda s, k, **kw: self.config[k])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fetch_messages_stops_on_empty_fetch(self):
+        consumer = FakeConsumer()
+        consumer.consumer.fetch.side_effect = ['a', 'b', None, 'c']
+        broker = rabbit.Broker()
+        self.assertEqual(unwrap(broker.fetch_messages(
+                                        consumer, consumer.max_messages)),
+                         ['a', 'b'])
+
+    def test_fetch_messages_respects_max_messages(self):
+        consumer = FakeConsumer(max_messages=2)
+        consumer.consumer.fetch.side_effect = ['a', 'b', 'c']
+        broker = rabbit.Broker()
+        self.assertEqual(unwrap(broker.fetch_messages(
+                                        consumer, consumer.max_messages)),
+                         ['a', 'b'])
+
+    def test_next_batch_holds_messages_until_full(self):
+        consumer = FakeConsumer(max_messages=3)
+        consumer.max_batch_latency = 60
+        consumer.consumer.fetch.side_effect = ['a', None, 'b', 'c', 'd']
+        broker = rabbit.Broker()
+        self.assertEqual(broker.next_batch(consumer), [])
+        self.assertEqual(unwrap(broker.next_batch(consumer)),
+                         ['a', 'b', 'c'])
+
+    def test_next_batch_dispatches_after_max_latency(self):
+        consumer = FakeConsumer(max_messages=3)
+        consumer.max_batch_latency = 60
+        consumer.consumer.fetch.side_effect = ['a', None, None]
+        broker = rabbit.Broker()
+        self.assertEqual(broker.next_batch(consumer), [])
+        broker.assemblers[consumer.queue_name].started -= 61
+        self.assertEqual(unwrap(broker.next_batch(consumer)), ['a'])
+
+    def test_connection_rotation_flushes_pending_batch(self):
+        consumer = FakeConsumer(max_messages=3)
+        consumer.max_batch_latency = 60
+        consumer.connect_time = datetime.datetime(2000, 1, 1)
+        consumer.consumer.fetch.side_effect = ['a', None]
+        broker = rabbit.Broker()
+        broker.establish_consumer_connection = mock.MagicMock()
+        self.assertEqual(broker.process_consumer(consumer, 10), 1)
+        messages = consumer.fetched_messages.call_args[0][0]
+        self.assertEqual(unwrap(messages), ['a'])
+        broker.establish_consumer_connection.assert_called_once_with(
+                                                                consumer)
+
+    def test_connection_age_limits_are_staggered(self):
+        broker = rabbit.Broker()
+        limits = set()
+        for n in range(10):
+            consumer = FakeConsumer(queue_name='q%d' % n)
+            limit = broker.connection_age_limit(consumer, 1000)
+            self.assertTrue(800 <= limit <= 1000)
+            self.assertEqual(broker.connection_age_limit(consumer, 1000),
+                             limit)
+            limits.add(limit)
+        self.assertTrue(len(limits) > 1)
+
+
+class BrokerShutdownTests(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(yagi.shutdown._requested.clear)
+        patcher = mock.patch.object(rabbit.conf, 'get', return_value='0')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_loop_stops_fetching_and_shuts_consumers_down(self):
+        consumer = FakeConsumer()
+        consumer.config = lambda key, default=None: default
+        consumer.shutdown = mock.MagicMock()
+        broker = rabbit.Broker()
+        broker.consumers.append(consumer)
+        calls = []
+
+        def process_consumer(c, max_connection_age):
+            calls.append(c)
+            yagi.shutdown.request()
+            return 1
+
+        broker.process_consumer = process_consumer
+        broker.loop()
+        self.assertEqual(calls, [consumer])
+        consumer.shutdown.assert_called_once_with()
+
+
+class ConsumeBrokerTests(unittest.TestCase):
+    def setUp(self):
+        self.config = {'prefetch_count': '50', 'consume_timeout': '0.1'}
+        patcher = mock.patch.object(rabbit.conf, 'get',
+                          side_effect=lambda s, k, **kw: self.config[k])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(rabbit.conf, 'config_with',
+                          return_value=lambda k, **kw: self.config[k])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _setup(self, consumer):
+        broker = rabbit.ConsumeBroker()
+        broker.setup_consumer(consumer)
+        callback = consumer.consumer.register_callback.call_args[0][0]
+        return broker, callback
+
+    def test_setup_consumer(self):
+        consumer = FakeConsumer()
+        self._setup(consumer)
+        consumer.consumer.qos.assert_called_once_with(prefetch_count=50)
+        self.assertTrue(consumer.consumer.consume.called)
+
+    def test_fetch_messages_batches_deliveries(self):
+        consumer = FakeConsumer(max_messages=2)
+        broker, callback = self._setup(consumer)
+        pending = ['a', 'b', 'c']
+
+        def drain_events(timeout=None):
+            self.assertEqual(timeout, 0.1)
+            if not pending:
+                raise socket.timeout()
+            callback(None, pending.pop(0))
+
+        consumer.connection.drain_events.side_effect = drain_events
+        self.assertEqual(unwrap(broker.fetch_messages(
+                                        consumer, consumer.max_messages)),
+                         ['a', 'b'])
+        self.assertEqual(unwrap(broker.fetch_messages(
+                                        consumer, consumer.max_messages)),
+                         ['c'])
+        self.assertEqual(unwrap(broker.fetch_messages(
+                                        consumer, consumer.max_messages)),
+                         [])
+
+    def test_flush_pending_drains_old_connection(self):
+        consumer = FakeConsumer(max_messages=2)
+        broker, callback = self._setup(consumer)
+        for message in ('a', 'b', 'c'):
+            callback(None, message)
+        self.assertEqual(broker.flush_pending(consumer), 3)
+        self.assertTrue(consumer.consumer.cancel.called)
+        batches = [unwrap(c[0][0])
+                   for c in consumer.fetched_messages.call_args_list]
+        self.assertEqual(batches, [['a', 'b'], ['c']])
+
+    def test_reconnect_drops_buffered_messages(self):
+        consumer = FakeConsumer()
+        broker, callback = self._setup(consumer)
+        callback(None, 'stale')
+        broker.setup_consumer(consumer)
+        consumer.connection.drain_events.side_effect = socket.timeout()
+        self.assertEqual(unwrap(broker.fetch_messages(
+                                        consumer, consumer.max_messages)),
+                         [])
+
+
+class ThreadedBrokerTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(rabbit.conf, 'get', return_value='0')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_worker_hands_failed_consumer_to_supervisor(self):
+        broker = rabbit.ThreadedBroker()
+        consumer = FakeConsumer()
+        done = threading.Event()
+        results = [socket.error("gone"), 2]
+
+        def process_consumer(c, max_connection_age):
+            if results:
+                result = results.pop(0)
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            done.set()
+            # Park the worker thread for the rest of the test run.
+            threading.Event().wait()
+
+        broker.process_consumer = process_consumer
+        broker.establish_consumer_connection = mock.MagicMock()
+        worker = rabbit.ConsumerWorker(broker, consumer, broker.failures)
+        worker.start()
+
+        failed = broker.failures.get(timeout=5)
+        self.assertTrue(failed is worker)
+        broker.reconnect(failed)
+        broker.establish_consumer_connection.assert_called_once_with(
+                                                                consumer)
+        done.wait(5)
+        self.assertEqual(worker.take_messages_sent(), 2)
+
+    def test_worker_rereads_settings_after_reload(self):
+        patcher = mock.patch.object(rabbit.conf, 'generation', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        broker = rabbit.ThreadedBroker()
+        ages = []
+        done = threading.Event()
+
+        def process_consumer(c, max_connection_age):
+            ages.append(max_connection_age)
+            if len(ages) == 1:
+                rabbit.conf.get.return_value = '60'
+                rabbit.conf.generation += 1
+                return 0
+            done.set()
+            threading.Event().wait()
+
+        broker.process_consumer = process_consumer
+        worker = rabbit.ConsumerWorker(broker, FakeConsumer(), None)
+        worker.start()
+        done.wait(5)
+        self.assertEqual(ages, [0, 60])
+
+    def test_idle_runs_on_worker(self):
+        consumer = FakeConsumer()
+        consumer.idle = mock.MagicMock()
+        worker = rabbit.ConsumerWorker(rabbit.ThreadedBroker(), consumer,
+                                       None)
+        worker._run_idle()
+        self.assertFalse(consumer.idle.called)
+        worker.request_idle(5)
+        worker._run_idle()
+        consumer.idle.assert_called_once_with(5, consumer.queue_name)
+
+
+class ConnectionManagerTests(unittest.TestCase):
+    def test_parses_host_list(self):
+        manager = rabbit.ConnectionManager("a, b:5673", 5672, 5, 600)
+        self.assertEqual(manager.hosts, [('a', 5672), ('b', 5673)])
+
+    def test_rotates_on_failure(self):
+        manager = rabbit.ConnectionManager("a,b", 5672, 5, 600)
+        manager.failed('a', 5672)
+        self.assertEqual(manager.current(), ('b', 5672))
+        # A stale failure report for a host we already left is ignored.
+        manager.failed('a', 5672)
+        self.assertEqual(manager.current(), ('b', 5672))
+        manager.failed('b', 5672)
+        self.assertEqual(manager.current(), ('a', 5672))
+
+    def test_backoff_is_jittered_and_capped(self):
+        manager = rabbit.ConnectionManager("a", 5672, 5, 600)
+        self.assertEqual(manager.backoff(0), 0)
+        for retries, delay in ((1, 5), (3, 20), (20, 600)):
+            for n in range(20):
+                backoff = manager.backoff(retries)
+                self.assertTrue(delay / 2.0 <= backoff <= delay)
+
+
+class EstablishConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.config = {'host': 'a,b', 'port': '5672', 'reconnect_delay': '0',
+                       'max_wait': '0', 'user': 'guest',
+                       'password': 'guest', 'vhost': '/', 'ssl': 'False'}
+        patcher = mock.patch.object(rabbit.conf, 'config_with',
+                          return_value=lambda k, **kw: self.config[k])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(rabbit, 'BrokerConnection')
+        self.connection_cls = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(rabbit, 'NotQuiteSoStupidConsumer')
+        self.consumer_cls = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fails_over_to_next_host(self):
+        self.consumer_cls.side_effect = [socket.error("down"),
+                                         mock.MagicMock()]
+        consumer = FakeConsumer()
+        consumer.config = lambda key: None
+        consumer.connect = mock.MagicMock()
+        broker = rabbit.Broker()
+        broker.establish_consumer_connection(consumer)
+        hosts = [c[1]['hostname'] for c in
+                 self.connection_cls.call_args_list]
+        self.assertEqual(hosts, ['a', 'b'])
+        self.assertEqual(consumer.connect.call_count, 1)
+
+
+class DeclareTests(unittest.TestCase):
+    def test_binds_queue_once_per_binding(self):
+        consumer = rabbit.NotQuiteSoStupidConsumer(
+                connection=mock.MagicMock(), queue='filtered',
+                exchange='nova', exchange_type='topic',
+                routing_key='notifications.info',
+                bindings=[('a', None), ('b', None)])
+        binds = consumer.backend.queue_bind.call_args_list
+        self.assertEqual([c[1]['routing_key'] for c in binds], ['a', 'b'])
@@ -0,0 +1,53 @@
+import unittest
+
+import mock
+
+import yagi.config
+from yagi.handler import routing
+
+
+class FakeMessage(object):
+    def __init__(self, event_type):
+        self.event_type = event_type
+
+
+class RoutingTests(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            ('filters', 'atompub'): 'compute.instance.exists.verified',
+            ('filters', 'cufpub'): 'compute.instance.*',
+            ('exclude_filters', 'cufpub'): 'compute.instance.update',
+        }
+        patcher = mock.patch.object(yagi.config, 'get',
+                    side_effect=lambda s, k, **kw: self.config.get((s, k)))
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Start every test from a fresh config generation.
+        patcher = mock.patch.object(yagi.config, 'generation', object())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_filter_matches_globs_and_excludes(self):
+        event_filter = routing.get_filter('cufpub')
+        self.assertTrue(event_filter.accepts('compute.instance.exists'))
+        self.assertFalse(event_filter.accepts('compute.instance.update'))
+        self.assertFalse(event_filter.accepts('image.upload'))
+
+    def test_filter_is_compiled_once_per_generation(self):
+        self.assertTrue(routing.get_filter('cufpub') is
+                        routing.get_filter('cufpub'))
+        calls = self.get.call_count
+        with mock.patch.object(yagi.config, 'generation', object()):
+            routing.get_filter('cufpub')
+        self.assertTrue(self.get.call_count > calls)
+
+    def test_route_partitions_batch(self):
+        exists = FakeMessage('compute.instance.exists.verified')
+        update = FakeMessage('compute.instance.update')
+        image = FakeMessage('image.upload')
+        messages = [exists, update, image]
+        table = routing.RoutingTable(['atompub', 'cufpub', 'null'])
+        routes = table.route(messages)
+        self.assertEqual(routes['atompub'], [exists])
+        self.assertEqual(routes['cufpub'], [exists])
+        self.assertTrue(routes['null'] is messages)
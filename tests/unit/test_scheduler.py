@@ -0,0 +1,63 @@
+import unittest
+
+import mock
+
+from yagi.broker.scheduler import WeightedScheduler
+
+
+class FakeConsumer(object):
+    def __init__(self, queue_name, **config):
+        self.queue_name = queue_name
+        self._config = config
+
+    def config(self, key, default=None):
+        return self._config.get(key, default)
+
+
+def run_round(scheduler, empty=()):
+    served = []
+    scheduler.start_round()
+    while True:
+        consumer = scheduler.next()
+        if consumer is None:
+            return served
+        served.append(consumer.queue_name)
+        num_messages = 0 if consumer.queue_name in empty else 1
+        scheduler.served(consumer, num_messages)
+
+
+class WeightedSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('yagi.stats.time_stat')
+        self.time_stat = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_default_is_round_robin(self):
+        scheduler = WeightedScheduler([FakeConsumer('a'), FakeConsumer('b'),
+                                       FakeConsumer('c')])
+        self.assertEqual(run_round(scheduler), ['a', 'b', 'c'])
+        self.assertEqual(self.time_stat.call_count, 3)
+
+    def test_slots_follow_weights(self):
+        scheduler = WeightedScheduler([FakeConsumer('exists', weight='3'),
+                                       FakeConsumer('other')])
+        self.assertEqual(run_round(scheduler),
+                         ['exists', 'exists', 'other', 'exists'])
+
+    def test_priority_goes_first(self):
+        scheduler = WeightedScheduler([FakeConsumer('other', weight='2'),
+                                       FakeConsumer('exists', priority='1')])
+        self.assertEqual(run_round(scheduler), ['exists', 'other', 'other'])
+
+    def test_empty_queue_gives_up_its_slots(self):
+        scheduler = WeightedScheduler([FakeConsumer('a', weight='5'),
+                                       FakeConsumer('b')])
+        self.assertEqual(run_round(scheduler, empty=['a']), ['a', 'b'])
+
+    def test_starved_queue_jumps_ahead(self):
+        scheduler = WeightedScheduler([FakeConsumer('exists', priority='1'),
+                                       FakeConsumer('other')],
+                                      starvation_limit=10)
+        scheduler.last_served['other'] -= 11
+        scheduler.start_round()
+        self.assertEqual(scheduler.next().queue_name, 'other')
@@ -0,0 +1,30 @@
+import signal
+import unittest
+
+import mock
+
+import yagi.config
+import yagi.shutdown
+
+
+class ShutdownTests(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(yagi.shutdown._requested.clear)
+
+    def test_wait_returns_early_once_requested(self):
+        self.assertFalse(yagi.shutdown.wait(0))
+        yagi.shutdown.request()
+        self.assertTrue(yagi.shutdown.wait(600))
+
+    def test_sigterm_starts_drain_deadline(self):
+        with mock.patch.object(yagi.config, 'get', return_value='15'):
+            with mock.patch.object(yagi.shutdown, 'signal') as sig:
+                yagi.shutdown._terminate(signal.SIGTERM, None)
+                yagi.shutdown._terminate(signal.SIGTERM, None)
+        self.assertTrue(yagi.shutdown.requested())
+        sig.alarm.assert_called_once_with(15)
+
+    def test_deadline_interrupts(self):
+        self.assertRaises(yagi.shutdown.ShutdownRequested,
+                          yagi.shutdown._deadline_passed, signal.SIGALRM,
+                          None)
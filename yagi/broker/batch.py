@@ -0,0 +1,32 @@
+import time
+
+
+class BatchAssembler(object):
+    """Accumulates fetched messages for one consumer until there are
+    enough for a full batch, or the oldest one has waited max_latency
+    seconds, whichever comes first."""
+
+    def __init__(self, max_latency):
+        self.max_latency = max_latency
+        self.messages = []
+        self.started = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, messages):
+        if messages and not self.messages:
+            self.started = time.time()
+        self.messages.extend(messages)
+
+    def ready(self, max_messages):
+        if not self.messages:
+            return False
+        if len(self.messages) >= max_messages:
+            return True
+        return time.time() - self.started >= self.max_latency
+
+    def take(self):
+        messages, self.messages = self.messages, []
+        self.started = None
+        return messages
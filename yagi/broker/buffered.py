@@ -0,0 +1,291 @@
+import logging
+import Queue
+import socket
+import threading
+import time
+
+import amqplib
+
+from yagi import config as conf
+from yagi.broker import rabbit
+from yagi.broker.message import DeferredMessage
+import yagi.shutdown
+import yagi.stats
+
+with conf.defaults_for("rabbit_broker") as default:
+    default("high_watermark", 1000)
+    default("low_watermark", 500)
+
+
+LOG = logging.getLogger(__name__)
+
+
+class HandoffQueue(object):
+    """Batches fetched for one consumer, waiting for its handler thread.
+
+    depth counts the messages that have been fetched but not yet handled.
+    Once it reaches the high watermark the broker stops fetching for this
+    consumer, and only starts again once the handlers have brought it
+    back down to the low watermark.
+
+    The handler thread can't use the AMQP channel, so acks and the like
+    come back through 'settlements' for the broker thread to send."""
+
+    def __init__(self, queue_name, high_watermark, low_watermark):
+        self.queue_name = queue_name
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.batches = Queue.Queue()
+        self.settlements = Queue.Queue()
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.paused = False
+        # Set while waiting for the queue to empty before reconnecting.
+        self.draining = False
+
+    def _changed(self, num_messages):
+        with self.lock:
+            self.depth += num_messages
+            depth = self.depth
+        yagi.stats.gauge_stat(yagi.stats.queue_depth(self.queue_name),
+                              depth)
+
+    def put(self, messages):
+        deferred = [DeferredMessage(m.message, self.settlements.put)
+                    for m in messages]
+        self._changed(len(deferred))
+        self.batches.put(deferred)
+
+    def get(self, timeout):
+        try:
+            return self.batches.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def done(self, messages):
+        self._changed(-len(messages))
+
+    def clear(self):
+        """Drops batches no handler has started on. Their messages are
+        redelivered once the connection they came in on is closed."""
+        while True:
+            try:
+                self.done(self.batches.get_nowait())
+            except Queue.Empty:
+                break
+
+    def accepting(self):
+        if self.draining:
+            return False
+        with self.lock:
+            depth = self.depth
+        if self.paused and depth <= self.low_watermark:
+            LOG.info("Resuming fetching for %s, %d messages queued" %
+                     (self.queue_name, depth))
+            self.paused = False
+        elif not self.paused and depth >= self.high_watermark:
+            LOG.warn("Handlers for %s falling behind, pausing fetching "
+                     "with %d messages queued" % (self.queue_name, depth))
+            self.paused = True
+        return not self.paused
+
+    def settle(self):
+        """Sends the acks, rejects and requeues the handlers asked for.
+        Only call this from the thread that owns the channel."""
+        while True:
+            try:
+                method, message = self.settlements.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                getattr(message, method)()
+            except Exception, e:
+                # The connection the message came in on is gone, the
+                # message will be redelivered.
+                LOG.debug("Could not %s message on %s: %s" %
+                          (method, self.queue_name, e))
+
+    def idle(self):
+        with self.lock:
+            depth = self.depth
+        return depth == 0 and self.settlements.empty()
+
+
+class HandlerWorker(rabbit.ConsumerWorker):
+    """Runs a consumer's handler chain on batches from its HandoffQueue."""
+
+    def __init__(self, broker, consumer, handoff):
+        super(HandlerWorker, self).__init__(broker, consumer, None)
+        self.handoff = handoff
+
+    def run(self):
+        while not yagi.shutdown.requested():
+            messages = self.handoff.get(timeout=1)
+            self._run_idle()
+            if messages is None:
+                continue
+            try:
+                self.consumer.fetched_messages(messages)
+            except Exception, e:
+                LOG.exception(e)
+            finally:
+                self.handoff.done(messages)
+            with self.lock:
+                self.messages_sent += len(messages)
+        self.stopped.set()
+
+
+class BufferedBroker(rabbit.Broker):
+    """Fetches on the main thread and handles on a thread per consumer,
+    with a bounded HandoffQueue between the two.
+
+    The broker keeps fetching while the handlers work, up to
+    high_watermark messages per consumer (from the consumer section or
+    [rabbit_broker]). Past that it stops fetching for that consumer until
+    the handlers catch up, so an AtomHopper outage doesn't pile up
+    messages in memory. Queue depth is reported as the
+    yagi.queue_depth.<queue> gauge."""
+
+    def __init__(self):
+        super(BufferedBroker, self).__init__()
+        self.handoffs = {}
+        self.workers = []
+
+    def get_handoff(self, consumer):
+        handoff = self.handoffs.get(consumer.queue_name)
+        if handoff is None:
+            high = int(consumer.config("high_watermark",
+                default=conf.get("rabbit_broker", "high_watermark")))
+            low = int(consumer.config("low_watermark",
+                default=conf.get("rabbit_broker", "low_watermark")))
+            handoff = HandoffQueue(consumer.queue_name, high, low)
+            self.handoffs[consumer.queue_name] = handoff
+        return handoff
+
+    def setup_consumer(self, consumer):
+        super(BufferedBroker, self).setup_consumer(consumer)
+        # Batches fetched on the old connection can't be acked on the
+        # new one, they will be redelivered instead.
+        handoff = self.get_handoff(consumer)
+        handoff.clear()
+        handoff.draining = False
+
+    def dispatch(self, consumer, messages):
+        self.get_handoff(consumer).put(messages)
+
+    def check_connection_age(self, consumer, max_connection_age):
+        """Rather than reconnecting with messages still queued or being
+        handled, stops fetching and waits for the handlers to finish
+        them."""
+        if not self.connection_expired(consumer, max_connection_age):
+            return 0
+        handoff = self.get_handoff(consumer)
+        if not handoff.draining:
+            LOG.info("Maximum AMQP connection time for connection to %s "
+                     "reached. Draining before reconnecting..." %
+                     consumer.queue_name)
+            handoff.draining = True
+            return self.flush_pending(consumer)
+        if handoff.idle():
+            handoff.draining = False
+            self.establish_consumer_connection(consumer)
+        return 0
+
+    def process_consumer(self, consumer, max_connection_age):
+        """Sends pending acks and fetches a batch, if the handlers have
+        room for it. Returns the number of messages fetched."""
+        consumer.ack_finished()
+        self.refresh_config(consumer)
+        handoff = self.get_handoff(consumer)
+        handoff.settle()
+        num_messages = 0
+        if handoff.accepting():
+            messages = self.next_batch(consumer)
+            num_messages = len(messages)
+            if num_messages:
+                self.dispatch(consumer, messages)
+        self.check_connection_age(consumer, max_connection_age)
+        return num_messages
+
+    def wait(self, seconds):
+        """Waits between polls, sending the handlers' acks as they come
+        in rather than leaving them until the next poll."""
+        deadline = time.time() + max(seconds, 0.1)
+        while not yagi.shutdown.wait(0.1):
+            for handoff in self.handoffs.values():
+                handoff.settle()
+            if time.time() >= deadline:
+                break
+
+    def shutdown(self):
+        """Drops batches the handlers haven't started, lets the ones in
+        progress finish until the drain deadline, sends their acks and
+        shuts the consumers down."""
+        for handoff in self.handoffs.values():
+            handoff.clear()
+        try:
+            for worker in self.workers:
+                handoff = self.get_handoff(worker.consumer)
+                while not worker.stopped.wait(0.1):
+                    handoff.settle()
+                handoff.settle()
+        except yagi.shutdown.ShutdownRequested:
+            LOG.error("Handlers did not finish draining in time")
+        super(BufferedBroker, self).shutdown()
+
+    def loop(self):
+        self.workers = [HandlerWorker(self, consumer,
+                                      self.get_handoff(consumer))
+                        for consumer in self.consumers]
+        for worker in self.workers:
+            worker.start()
+
+        start_time = time.time()
+        generation = None
+        while not yagi.shutdown.requested():
+            try:
+                if generation != conf.generation:
+                    # Picks up changes from a config reload.
+                    poll_delay = self.get_poll_delay()
+                    update_timer = int(conf.get("global", "update_timer"))
+                    max_connection_age = int(conf.get("rabbit_broker",
+                                                      "max_connection_age"))
+                    generation = conf.generation
+                fetched = 0
+                for consumer in self.consumers:
+                    try:
+                        fetched += self.process_consumer(consumer,
+                                                         max_connection_age)
+                    except socket.error, e:
+                        self.connection_lost(consumer, e)
+                    except amqplib.client_0_8.exceptions.AMQPException, e:
+                        self.connection_lost(consumer, e)
+
+                elapsed = int(time.time() - start_time)
+                if elapsed > update_timer:
+                    messages_sent = dict((w.consumer.queue_name,
+                                          w.take_messages_sent())
+                                         for w in self.workers)
+                    self.report(elapsed, messages_sent)
+                    start_time = time.time()
+                    for worker in self.workers:
+                        worker.request_idle(
+                            messages_sent[worker.consumer.queue_name])
+
+                if not fetched:
+                    self.wait(poll_delay)
+            except yagi.shutdown.ShutdownRequested:
+                pass
+            except Exception, e:
+                LOG.exception(e)
+        self.shutdown()
+
+
+class BufferedConsumeBroker(BufferedBroker, rabbit.ConsumeBroker):
+    """BufferedBroker fed by push based (basic_consume) deliveries.
+
+    Not fetching doesn't stop the server pushing messages, but the QoS
+    prefetch window does: with every delivered message sitting unacked
+    in the HandoffQueue, the server stops sending once prefetch_count is
+    reached. Keep prefetch_count at or below high_watermark."""
+    pass
@@ -0,0 +1,131 @@
+"""Broker driver that feeds consumers from Python iterables rather than
+an AMQP server. Mostly useful for benchmarking handler chains."""
+
+import collections
+import itertools
+import logging
+import time
+
+import yagi.config
+import yagi.utils
+
+
+with yagi.config.defaults_for("memory_broker") as default:
+    default("source", "")
+
+
+LOG = logging.getLogger(__name__)
+
+
+class MessageStateError(Exception):
+    pass
+
+
+class Message(object):
+    """Stands in for a carrot message, with the same payload, ack,
+    reject, requeue and acknowledged interface the handlers use."""
+
+    def __init__(self, payload, delivery_tag=None, on_requeue=None):
+        self.payload = payload
+        self.delivery_tag = delivery_tag
+        self.on_requeue = on_requeue
+        self._state = "RECEIVED"
+
+    @property
+    def acknowledged(self):
+        return self._state in ("ACK", "REJECTED", "REQUEUED")
+
+    def _set_state(self, state):
+        if self.acknowledged:
+            raise MessageStateError(
+                "Message already acknowledged with state: %s" % self._state)
+        self._state = state
+
+    def ack(self):
+        self._set_state("ACK")
+
+    def reject(self):
+        self._set_state("REJECTED")
+
+    def requeue(self):
+        self._set_state("REQUEUED")
+        if self.on_requeue:
+            self.on_requeue(self.payload)
+
+
+class Broker(object):
+    """Hands each consumer batches of max_messages payloads from its
+    source until every source runs dry, then reports throughput and
+    returns.
+
+    Sources are given with feed(), or through [memory_broker] source:
+    the dotted name of a callable taking the queue name and returning an
+    iterable of notification payloads."""
+
+    def __init__(self):
+        self.consumers = []
+        self.sources = {}
+        self.requeued = {}
+        self.delivery_tags = itertools.count(1)
+
+    def feed(self, queue_name, payloads):
+        self.sources[queue_name] = iter(payloads)
+        self.requeued[queue_name] = collections.deque()
+
+    def source_for(self, consumer):
+        source = yagi.config.get("memory_broker", "source")
+        if source:
+            return yagi.utils.import_class(source)(consumer.queue_name)
+        return None
+
+    def add_consumer(self, consumer):
+        if consumer.queue_name not in self.sources:
+            payloads = self.source_for(consumer)
+            self.feed(consumer.queue_name, payloads or [])
+        consumer.connect(None, None)
+        self.consumers.append(consumer)
+
+    def fetch_messages(self, consumer, limit):
+        requeued = self.requeued[consumer.queue_name]
+        payloads = itertools.chain(
+            (requeued.popleft() for n in xrange(len(requeued))),
+            self.sources[consumer.queue_name])
+        return [Message(payload, delivery_tag=self.delivery_tags.next(),
+                        on_requeue=requeued.append)
+                for payload in itertools.islice(payloads, limit)]
+
+    def report(self, elapsed, messages_sent):
+        LOG.info("Sources exhausted after %.3f seconds" % elapsed)
+        total_messages = 0
+        for consumer in self.consumers:
+            sent = messages_sent[consumer.queue_name]
+            LOG.info("\tSent %d messages from %s" % (sent,
+                                                     consumer.queue_name))
+            total_messages += sent
+        LOG.info("\tSent %d total messages" % total_messages)
+        if total_messages > 0 and elapsed > 0:
+            LOG.info("\tMessages per second: %f" %
+                     (float(total_messages) / elapsed))
+
+    def loop(self):
+        messages_sent = dict((c.queue_name, 0) for c in self.consumers)
+        start_time = time.time()
+        while True:
+            dispatched = 0
+            for consumer in self.consumers:
+                consumer.ack_finished()
+                messages = self.fetch_messages(consumer,
+                                               consumer.max_messages)
+                if messages:
+                    consumer.fetched_messages(messages)
+                    messages_sent[consumer.queue_name] += len(messages)
+                    dispatched += len(messages)
+            if not dispatched:
+                break
+        for consumer in self.consumers:
+            consumer.wait_finished()
+        self.report(time.time() - start_time, messages_sent)
+        for consumer in self.consumers:
+            consumer.idle(messages_sent[consumer.queue_name],
+                          consumer.queue_name)
+        return messages_sent
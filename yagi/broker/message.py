@@ -0,0 +1,138 @@
+import re
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+JSON_CONTENT_TYPES = (None, "application/json")
+
+# Match "<key>": "<value>" without decoding the body. Values with escapes
+# in them are left to the real decoder.
+PEEK_RE = r'"%s"\s*:\s*"([^"\\]*)"'
+EVENT_TYPE_RE = re.compile(PEEK_RE % "event_type")
+MESSAGE_ID_RE = re.compile(PEEK_RE % "message_id")
+
+
+class LazyMessage(object):
+    """Wraps a broker message so its body is only decoded when somebody
+    actually looks at the payload.
+
+    event_type can usually be read straight out of the raw body, so
+    messages that get filtered out by event type are never decoded at
+    all. Everything else (ack, reject, delivery_tag...) is passed through
+    to the wrapped message."""
+
+    def __init__(self, message):
+        self.message = message
+        self._payload = None
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    def _get_state(self):
+        return self.message._state
+
+    def _set_state(self, state):
+        self.message._state = state
+
+    _state = property(_get_state, _set_state)
+
+    @property
+    def acknowledged(self):
+        return self.message.acknowledged
+
+    def ack(self):
+        return self.message.ack()
+
+    def reject(self):
+        return self.message.reject()
+
+    def requeue(self):
+        return self.message.requeue()
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            if self.message.content_type in JSON_CONTENT_TYPES:
+                self._payload = json.loads(self.message.body)
+            else:
+                self._payload = self.message.payload
+        return self._payload
+
+    def _peek(self, regex):
+        """The value regex finds in the raw body, or None if it can't be
+        read without decoding."""
+        if self._payload is None and isinstance(self.message.body,
+                                                basestring):
+            found = regex.findall(self.message.body)
+            # More than one match means some nested dict has the same
+            # key too, and we can't tell which is ours.
+            if len(found) == 1:
+                return found[0]
+        return None
+
+    @property
+    def event_type(self):
+        value = self._peek(EVENT_TYPE_RE)
+        if value is None:
+            value = self.payload['event_type']
+        return value
+
+    @property
+    def message_id(self):
+        value = self._peek(MESSAGE_ID_RE)
+        if value is None:
+            value = self.payload.get('message_id')
+        return value
+
+
+ACKNOWLEDGED_STATES = ("ACK", "REJECTED", "REQUEUED")
+
+
+class DeferredMessage(LazyMessage):
+    """A LazyMessage for handlers running on a different thread from the
+    one that owns the AMQP channel, which isn't safe to share.
+
+    ack, reject and requeue update the message state right away, but the
+    actual AMQP call is handed to 'settle' as a (method name, message)
+    pair, for the channel's own thread to make later on."""
+
+    def __init__(self, message, settle):
+        super(DeferredMessage, self).__init__(message)
+        self.settle = settle
+        self.state = "RECEIVED"
+
+    def _get_state(self):
+        return self.state
+
+    def _set_state(self, state):
+        self.state = state
+
+    _state = property(_get_state, _set_state)
+
+    @property
+    def acknowledged(self):
+        return self.state in ACKNOWLEDGED_STATES
+
+    @property
+    def backend(self):
+        # Keeps callers from reaching for the channel themselves.
+        return None
+
+    def _settle(self, method, state):
+        if self.acknowledged:
+            raise self.message.MessageStateError(
+                "Message already acknowledged with state: %s" % self.state)
+        self.state = state
+        self.settle((method, self.message))
+
+    def ack(self):
+        self._settle("ack", "ACK")
+
+    def reject(self):
+        self._settle("reject", "REJECTED")
+
+    def requeue(self):
+        self._settle("requeue", "REQUEUED")
@@ -1,5 +1,8 @@
 import datetime
+import Queue
+import random
 import socket
+import threading
 import time
 import logging
 
@@ -8,6 +11,11 @@ from carrot.connection import BrokerConnection
 from carrot.messaging import Consumer
 
 from yagi import config as conf
+import yagi.shutdown
+import yagi.stats
+from yagi.broker.batch import BatchAssembler
+from yagi.broker.message import LazyMessage
+from yagi.broker.scheduler import WeightedScheduler
 
 with conf.defaults_for("global") as default:
     default("update_timer", 300)
@@ -22,7 +30,11 @@ with conf.defaults_for("rabbit_broker") as default:
     default("reconnect_delay", 5)
     default("max_wait", 600)
     default("max_connection_age", 14400)
+    default("connection_age_jitter", 0.2)
     default("ssl", False)
+    default("prefetch_count", 100)
+    default("consume_timeout", 1)
+    default("starvation_limit", 30)
 
 
 LOG = logging.getLogger(__name__)
@@ -47,10 +59,14 @@ class NotQuiteSoStupidConsumer(Consumer):
     queues this way."""
 
     _init_opts = Consumer._init_opts + ("exchange_durable",
-                                        "exchange_auto_delete")
+                                        "exchange_auto_delete",
+                                        "bindings")
 
     exchange_durable = None
     exchange_auto_delete = None
+    # A list of (routing_key, arguments) pairs to bind the queue with,
+    # instead of the single routing_key. See Consumer.bindings()
+    bindings = None
 
     def declare(self):
         """Declares the queue, the exchange and binds the queue to
@@ -77,39 +93,87 @@ class NotQuiteSoStupidConsumer(Consumer):
                                           type=self.exchange_type,
                                           durable=edurable,
                                           auto_delete=eauto_delete)
+        bindings = self.bindings
+        if bindings is None:
+            bindings = [(routing_key, arguments)]
         if self.queue:
-            self.backend.queue_bind(queue=self.queue,
-                                    exchange=self.exchange,
-                                    routing_key=routing_key,
-                                    arguments=arguments)
+            for routing_key, arguments in bindings:
+                self.backend.queue_bind(queue=self.queue,
+                                        exchange=self.exchange,
+                                        routing_key=routing_key,
+                                        arguments=arguments)
         self._closed = False
         return self
 
+    def _receive_callback(self, raw_message):
+        """Unlike carrot's, this doesn't decode the message body before
+        handing it to the callbacks, which get None as message_data."""
+        message = self.backend.message_to_python(raw_message)
+        if self.auto_ack and not message.acknowledged:
+            message.ack()
+        for callback in self.callbacks:
+            callback(None, message)
+
+
+class ConnectionManager(object):
+    """Picks which broker host to connect to.
+
+    'host' may be a comma separated list of host or host:port entries.
+    All consumers share the same manager: once a host fails, everybody
+    moves on to the next one. Retries back off exponentially, with
+    jitter so consumers don't all hit the broker at the same moment."""
+
+    def __init__(self, hosts, default_port, reconnect_delay, max_wait):
+        self.hosts = []
+        for host in hosts.split(","):
+            hostname, sep, port = host.strip().partition(":")
+            self.hosts.append((hostname, int(port or default_port)))
+        self.reconnect_delay = reconnect_delay
+        self.max_wait = max_wait
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        return self.hosts[self.index]
+
+    def failed(self, hostname, port):
+        with self.lock:
+            # Someone else may have rotated away from it already.
+            if self.hosts[self.index] == (hostname, port):
+                self.index = (self.index + 1) % len(self.hosts)
+
+    def backoff(self, retries):
+        if not retries:
+            return 0
+        delay = min(self.reconnect_delay * (2 ** (retries - 1)),
+                    self.max_wait)
+        return random.uniform(delay / 2.0, delay)
+
 
 class Broker(object):
     def __init__(self):
         self.consumers = []
+        self.assemblers = {}
+        self.connection_age_limits = {}
+        self.connection_manager = None
 
     def add_consumer(self, consumer):
         self.establish_consumer_connection(consumer)
         self.consumers.append(consumer)
 
+    def get_connection_manager(self):
+        if self.connection_manager is None:
+            config = conf.config_with("rabbit_broker")
+            self.connection_manager = ConnectionManager(
+                                        config("host"),
+                                        int(config("port")),
+                                        int(config("reconnect_delay")),
+                                        int(config("max_wait")))
+        return self.connection_manager
+
     def establish_consumer_connection(self, consumer):
-        # for now all consumers use the same queue connection
-        # That may not be the case forever
         config = conf.config_with("rabbit_broker")
-        reconnect_delay = int(config("reconnect_delay"))
-        max_wait = int(config("max_wait"))
-
-        # This just sets the connection string. It doesn't actually
-        # connect to the AMQP server yet.
-        connection = BrokerConnection(
-                        hostname=config("host"),
-                        port=config("port"),
-                        userid=config("user"),
-                        password=config("password"),
-                        virtual_host=config("vhost"),
-                        ssl=confbool("ssl"))
+        manager = self.get_connection_manager()
 
         auto_delete = consumer.config("auto_delete") == "True" or False
         durable = consumer.config("durable") == "True" or False
@@ -119,7 +183,18 @@ class Broker(object):
 
         # try a few times to connect, we might have lost the connection
         retries = 0
+        start = time.time()
         while True:
+            hostname, port = manager.current()
+            # This just sets the connection string. It doesn't actually
+            # connect to the AMQP server yet.
+            connection = BrokerConnection(
+                            hostname=hostname,
+                            port=port,
+                            userid=config("user"),
+                            password=config("password"),
+                            virtual_host=config("vhost"),
+                            ssl=confbool(config("ssl")))
             try:
                 carrot_consumer = NotQuiteSoStupidConsumer(
                         connection=connection,
@@ -132,9 +207,12 @@ class Broker(object):
                         durable=durable,
                         exchange_durable=exdurable,
                         exchange_auto_delete=exauto_delete,
+                        bindings=consumer.bindings(),
                         )
                 consumer.connect(connection, carrot_consumer)
-                LOG.info("Connection established for %s" % consumer.queue_name)
+                self.setup_consumer(consumer)
+                LOG.info("Connection established for %s on %s:%s" %
+                         (consumer.queue_name, hostname, port))
                 break
             except amqplib.client_0_8.exceptions.AMQPConnectionException, e:
                 LOG.error("AMQP protocol error connecting to for queue %s" %
@@ -143,48 +221,194 @@ class Broker(object):
             except socket.error, e:
                 # lost connection?
                 pass
-            delay = reconnect_delay * retries
-            if delay > max_wait:
-                delay = max_wait
+            try:
+                connection.close()
+            except Exception:
+                pass
+            manager.failed(hostname, port)
+            delay = manager.backoff(retries)
             retries += 1
-            LOG.error("Could not reconnect, trying again in %d" % delay)
-            time.sleep(delay)
+            LOG.error("Could not connect to %s:%s, trying %s:%s in %.1f" %
+                      ((hostname, port) + manager.current() + (delay,)))
+            if yagi.shutdown.wait(delay):
+                raise yagi.shutdown.ShutdownRequested(
+                        "Shutting down, giving up reconnecting %s" %
+                        consumer.queue_name)
+
+        if retries:
+            elapsed = time.time() - start
+            LOG.info("Reconnected %s after %.1f seconds and %d retries" %
+                     (consumer.queue_name, elapsed, retries))
+            yagi.stats.time_stat(yagi.stats.reconnect_message(), elapsed)
+
+    def setup_consumer(self, consumer):
+        """Called once a consumer has a fresh connection."""
+        # Messages assembled from the old connection can't be acked
+        # anymore, they will be redelivered.
+        self.assemblers.pop(consumer.queue_name, None)
+        self.connection_age_limits.pop(consumer.queue_name, None)
+
+    def get_poll_delay(self):
+        return float(conf.get("rabbit_broker", "poll_delay"))
+
+    def fetch_messages(self, consumer, limit):
+        messages = []
+        for n in xrange(limit):
+            msg = consumer.consumer.fetch(enable_callbacks=False)
+            if not msg:
+                break
+            LOG.debug("Received message on queue %s" % consumer.queue_name)
+            messages.append(LazyMessage(msg))
+        return messages
+
+    def next_batch(self, consumer):
+        """Returns the next batch to dispatch, which may be empty.
+
+        Without a max_batch_latency this is simply whatever could be
+        fetched right now. With one, messages are held back across calls
+        until a full batch has built up or the oldest message has waited
+        that long."""
+        assembler = self.assemblers.get(consumer.queue_name)
+        if not consumer.max_batch_latency and assembler is None:
+            return self.fetch_messages(consumer, consumer.max_messages)
+        if assembler is None:
+            assembler = BatchAssembler(consumer.max_batch_latency)
+            self.assemblers[consumer.queue_name] = assembler
+        # max_batch_latency can change when the config is reloaded.
+        assembler.max_latency = consumer.max_batch_latency
+        limit = consumer.max_messages - len(assembler)
+        if limit > 0:
+            assembler.add(self.fetch_messages(consumer, limit))
+        if assembler.ready(consumer.max_messages):
+            return assembler.take()
+        return []
+
+    def flush_pending(self, consumer):
+        """Dispatches any partially assembled batch. Returns the number of
+        messages handled."""
+        assembler = self.assemblers.get(consumer.queue_name)
+        if not assembler:
+            return 0
+        messages = assembler.take()
+        self.dispatch(consumer, messages)
+        return len(messages)
+
+    def dispatch(self, consumer, messages):
+        """Hands a batch to the consumer's handler chain."""
+        consumer.fetched_messages(messages)
+
+    def connection_age_limit(self, consumer, max_connection_age):
+        """Each connection gets its own maximum age, somewhat below
+        max_connection_age, so consumers that connected together don't
+        all reconnect at the same moment."""
+        limit = self.connection_age_limits.get(consumer.queue_name)
+        if limit is None:
+            jitter = float(conf.get("rabbit_broker",
+                                    "connection_age_jitter"))
+            limit = max_connection_age * (1 - jitter * random.random())
+            self.connection_age_limits[consumer.queue_name] = limit
+        return limit
+
+    def connection_expired(self, consumer, max_connection_age):
+        if max_connection_age <= 0:
+            return False
+        age = datetime.datetime.now() - consumer.connect_time
+        age_sec = age.seconds + (age.days * 86400)
+        return age_sec > self.connection_age_limit(consumer,
+                                                   max_connection_age)
+
+    def check_connection_age(self, consumer, max_connection_age):
+        """Reconnects the consumer if its connection is too old. Returns
+        the number of messages handled before doing so."""
+        if self.connection_expired(consumer, max_connection_age):
+            LOG.info("Maximum AMQP connection time for "
+                     "connection to %s reached. "
+                     "Reconnecting..." % consumer.queue_name)
+            num_messages = self.flush_pending(consumer)
+            # The replacement connection is opened before the
+            # consumer lets go of the old one.
+            self.establish_consumer_connection(consumer)
+            return num_messages
+        return 0
+
+    def refresh_config(self, consumer):
+        """Swaps in a reloaded config (see yagi.config.request_reload),
+        between the consumer's batches."""
+        conf.reload_if_requested()
+        consumer.refresh_config()
+
+    def process_consumer(self, consumer, max_connection_age):
+        """Fetches and dispatches one batch for the consumer. Returns the
+        number of messages handled."""
+        consumer.ack_finished()
+        self.refresh_config(consumer)
+        messages = self.next_batch(consumer)
+        num_messages = len(messages)
+        if num_messages > 0:
+            self.dispatch(consumer, messages)
+        num_messages += self.check_connection_age(consumer,
+                                                  max_connection_age)
+        return num_messages
+
+    def connection_lost(self, consumer, e):
+        LOG.critical("Rabbit connection lost for %s, reconnecting" %
+                     consumer.queue_name)
+        LOG.exception(e)
+        self.establish_consumer_connection(consumer)
+
+    def report(self, elapsed, messages_sent):
+        LOG.info("Update timer elapsed: %s seconds", str(elapsed))
+        total_messages = 0
+        for consumer in self.consumers:
+            sent = messages_sent.get(consumer.queue_name, 0)
+            LOG.info("\tSent %d messages from %s" %
+                              (sent, consumer.queue_name))
+            total_messages += sent
+        LOG.info("\tSent %d total messages" % total_messages)
+        if total_messages > 0:
+            LOG.info("\tMessages per second: %f" %
+                        (float(total_messages) / elapsed))
+
+    def shutdown(self):
+        """Lets the handlers flush whatever they buffer and closes the
+        connections. RabbitMQ redelivers whatever was left unacked,
+        including any messages held back in a partial batch."""
+        for consumer in self.consumers:
+            consumer.shutdown()
+        yagi.shutdown.finished()
 
     def loop(self):
-        poll_delay = float(conf.get("rabbit_broker", "poll_delay"))
-        update_timer = int(conf.get("global", "update_timer"))
-        max_connection_age = int(conf.get("rabbit_broker",
-                                          "max_connection_age"))
+        scheduler = WeightedScheduler(self.consumers, float(
+                conf.get("rabbit_broker", "starvation_limit")))
         start_time = datetime.datetime.now()
         messages_sent = {}
-        while True:
+        generation = None
+        while not yagi.shutdown.requested():
             try:
-                for consumer in self.consumers:
-                    messages = []
+                if generation != conf.generation:
+                    # Picks up changes from a config reload.
+                    poll_delay = self.get_poll_delay()
+                    update_timer = int(conf.get("global", "update_timer"))
+                    max_connection_age = int(conf.get("rabbit_broker",
+                                                      "max_connection_age"))
+                    generation = conf.generation
+                scheduler.start_round()
+                while not yagi.shutdown.requested():
+                    consumer = scheduler.next()
+                    if consumer is None:
+                        break
                     if not consumer.queue_name in messages_sent:
                         messages_sent[consumer.queue_name] = 0
-
-                    for n in xrange(consumer.max_messages):
-                        msg = consumer.consumer.fetch(enable_callbacks=False)
-                        if not msg:
-                            break
-                        LOG.debug("Received message on queue %s" %
-                            consumer.queue_name)
-                        messages.append(msg)
-
-                    num_messages = len(messages)
-                    if num_messages > 0:
-                        consumer.fetched_messages(messages)
-                        messages_sent[consumer.queue_name] += num_messages
-                    if max_connection_age > 0:
-                        age = datetime.datetime.now() - consumer.connect_time
-                        age_sec = age.seconds + (age.days * 86400)
-                        if age_sec > max_connection_age:
-                            LOG.info("Maximum AMQP connection time for "
-                                     "connection to %s reached. "
-                                     "Reconnecting..." % consumer.queue_name)
-                            self.establish_consumer_connection(consumer)
-
+                    num_messages = 0
+                    try:
+                        num_messages = self.process_consumer(
+                                            consumer, max_connection_age)
+                    except socket.error, e:
+                        self.connection_lost(consumer, e)
+                    except amqplib.client_0_8.exceptions.AMQPException, e:
+                        self.connection_lost(consumer, e)
+                    messages_sent[consumer.queue_name] += num_messages
+                    scheduler.served(consumer, num_messages)
 
                 # Ingnoring microseconds because we're not going to let you
                 # be that granular and it's not super useful anyway
@@ -193,18 +417,7 @@ class Broker(object):
 
                 if elapsed > update_timer:
                     # This isn't threaded, it's just best effort
-                    LOG.info("Update timer elapsed: %s seconds", str(elapsed))
-                    total_messages = 0
-                    for consumer in self.consumers:
-                        LOG.info("\tSent %d messages from %s" %
-                                          (messages_sent[consumer.queue_name],
-                                           consumer.queue_name))
-                        total_messages += messages_sent[consumer.queue_name]
-                    LOG.info("\tSent %d total messages" % total_messages)
-                    if total_messages > 0:
-                        LOG.info("\tMessages per second: %f" %
-                                    (float(total_messages) / elapsed))
-
+                    self.report(elapsed, messages_sent)
                     start_time = datetime.datetime.now()
 
                     # Periodically call the consumers in case they need
@@ -219,14 +432,219 @@ class Broker(object):
                 # in the flood of messages and coupled with DEBUG logging.
                 # Otherwise, we want Yagi sending as quickly as possible
                 if poll_delay:
-                    time.sleep(poll_delay)
-            except socket.error, e:
-                LOG.critical("Rabbit connection lost, reconnecting")
+                    yagi.shutdown.wait(poll_delay)
+            except yagi.shutdown.ShutdownRequested:
+                pass
+            except Exception, e:
                 LOG.exception(e)
-                self.establish_consumer_connection(consumer)
+        self.shutdown()
+
+
+class ConsumeBroker(Broker):
+    """Push based variant of the Broker.
+
+    Rather than polling each queue with basic_get (one round trip per
+    message), this registers a basic_consume subscription per queue with
+    a QoS prefetch window and lets the broker stream messages to us.
+    Delivered messages are buffered per queue and handed to the consumer
+    in batches of up to max_messages."""
+
+    def __init__(self):
+        super(ConsumeBroker, self).__init__()
+        self.buffers = {}
+
+    def setup_consumer(self, consumer):
+        super(ConsumeBroker, self).setup_consumer(consumer)
+        config = conf.config_with("rabbit_broker")
+        prefetch_count = int(config("prefetch_count"))
+        # Anything buffered from the previous connection can no longer be
+        # acked on the new channel, it will be redelivered instead.
+        buf = self.buffers[consumer.queue_name] = []
+
+        def _receive(message_data, message):
+            buf.append(LazyMessage(message))
+
+        carrot_consumer = consumer.consumer
+        carrot_consumer.qos(prefetch_count=prefetch_count)
+        carrot_consumer.register_callback(_receive)
+        carrot_consumer.consume()
+
+    def flush_pending(self, consumer):
+        """Stops deliveries on the current connection and dispatches
+        everything already delivered on it, so rotating the connection
+        doesn't cause redeliveries."""
+        consumer.consumer.cancel()
+        num_messages = super(ConsumeBroker, self).flush_pending(consumer)
+        buf = self.buffers.get(consumer.queue_name, [])
+        while buf:
+            messages = buf[:consumer.max_messages]
+            del buf[:consumer.max_messages]
+            self.dispatch(consumer, messages)
+            num_messages += len(messages)
+        return num_messages
+
+    def get_poll_delay(self):
+        # Waiting on the socket in fetch_messages takes the place of
+        # sleeping between polls.
+        return 0
+
+    def fetch_messages(self, consumer, limit):
+        timeout = float(conf.get("rabbit_broker", "consume_timeout"))
+        buf = self.buffers[consumer.queue_name]
+        while len(buf) < limit:
+            try:
+                consumer.connection.drain_events(timeout=timeout)
+            except socket.timeout:
+                break
+        messages = buf[:limit]
+        del buf[:limit]
+        if messages:
+            LOG.debug("Received %d messages on queue %s" %
+                      (len(messages), consumer.queue_name))
+        return messages
+
+
+class ConsumerWorker(threading.Thread):
+    """Runs the fetch/dispatch cycle for a single consumer on its own
+    thread, so a slow handler chain only holds up its own queue."""
+
+    def __init__(self, broker, consumer, failures):
+        super(ConsumerWorker, self).__init__(
+                                name="yagi-%s" % consumer.queue_name)
+        self.daemon = True
+        self.broker = broker
+        self.consumer = consumer
+        self.failures = failures
+        self.reconnected = threading.Event()
+        self.lock = threading.Lock()
+        self.messages_sent = 0
+        self.pending_idle = None
+        self.stopped = threading.Event()
+
+    def take_messages_sent(self):
+        with self.lock:
+            sent, self.messages_sent = self.messages_sent, 0
+        return sent
+
+    def request_idle(self, num_messages):
+        # idle() runs on the worker's own thread, between batches, so the
+        # handlers never see two threads at once.
+        with self.lock:
+            self.pending_idle = num_messages
+
+    def _run_idle(self):
+        with self.lock:
+            num_messages, self.pending_idle = self.pending_idle, None
+        if num_messages is not None:
+            self.consumer.idle(num_messages, self.consumer.queue_name)
+
+    def _connection_lost(self, e):
+        LOG.critical("Rabbit connection lost for %s, reconnecting" %
+                     self.consumer.queue_name)
+        LOG.exception(e)
+        self.reconnected.clear()
+        self.failures.put(self)
+        self.reconnected.wait()
+
+    def run(self):
+        generation = None
+        while not yagi.shutdown.requested():
+            if generation != conf.generation:
+                # Picks up changes from a config reload.
+                poll_delay = self.broker.get_poll_delay()
+                max_connection_age = int(conf.get("rabbit_broker",
+                                                  "max_connection_age"))
+                generation = conf.generation
+            try:
+                num_messages = self.broker.process_consumer(
+                                    self.consumer, max_connection_age)
+                with self.lock:
+                    self.messages_sent += num_messages
+                self._run_idle()
+            except socket.error, e:
+                self._connection_lost(e)
+                continue
             except amqplib.client_0_8.exceptions.AMQPException, e:
-                LOG.critical("Rabbit connection lost, reconnecting")
-                LOG.exception(e)
-                self.establish_consumer_connection(consumer)
+                self._connection_lost(e)
+                continue
             except Exception, e:
                 LOG.exception(e)
+            if poll_delay:
+                yagi.shutdown.wait(poll_delay)
+        self.consumer.shutdown()
+        self.stopped.set()
+
+
+class ThreadedBroker(Broker):
+    """Runs every consumer in its own worker thread.
+
+    Each worker has its own broker connection and does its own fetching
+    and batching. The main thread acts as a supervisor: it re-establishes
+    connections for workers that lost theirs and does the update_timer
+    reporting and idle scheduling that Broker.loop does inline."""
+
+    def __init__(self):
+        super(ThreadedBroker, self).__init__()
+        self.workers = []
+        self.failures = Queue.Queue()
+
+    def reconnect(self, worker):
+        try:
+            self.establish_consumer_connection(worker.consumer)
+        except Exception, e:
+            LOG.exception(e)
+            # Try again on the next pass of the supervisor loop.
+            self.failures.put(worker)
+            return
+        worker.reconnected.set()
+
+    def loop(self):
+        self.workers = [ConsumerWorker(self, consumer, self.failures)
+                        for consumer in self.consumers]
+        for worker in self.workers:
+            worker.start()
+
+        start_time = time.time()
+        generation = None
+        while not yagi.shutdown.requested():
+            if generation != conf.generation:
+                # Picks up changes from a config reload.
+                update_timer = int(conf.get("global", "update_timer"))
+                generation = conf.generation
+            try:
+                # Short timeout, so a shutdown request is noticed quickly.
+                worker = self.failures.get(timeout=1)
+                self.reconnect(worker)
+            except Queue.Empty:
+                pass
+
+            elapsed = int(time.time() - start_time)
+            if elapsed > update_timer:
+                messages_sent = dict((w.consumer.queue_name,
+                                      w.take_messages_sent())
+                                     for w in self.workers)
+                self.report(elapsed, messages_sent)
+                start_time = time.time()
+                for worker in self.workers:
+                    worker.request_idle(
+                        messages_sent[worker.consumer.queue_name])
+        self.shutdown()
+
+    def shutdown(self):
+        """Waits for the workers to finish their batches and shut their
+        consumers down, until the drain deadline interrupts the wait."""
+        for worker in self.workers:
+            # Workers waiting on a reconnect won't get one now.
+            worker.reconnected.set()
+        try:
+            for worker in self.workers:
+                while not worker.stopped.wait(1):
+                    pass
+        except yagi.shutdown.ShutdownRequested:
+            LOG.error("Workers did not finish draining in time")
+        yagi.shutdown.finished()
+
+
+class ThreadedConsumeBroker(ThreadedBroker, ConsumeBroker):
+    """ThreadedBroker with push based (basic_consume) workers."""
+    pass
@@ -0,0 +1,91 @@
+"""Broker driver that replays archived notifications from disk as fast
+as the handlers will take them.
+
+Each consumer reads the files listed in 'replay_path' in its
+[consumer:*] section, falling back to [replay_broker] path. Both take a
+comma separated list of files or glob patterns. Files ending in .dat are
+read as shoebox archives, .gz files as gzipped JSON lines (as written by
+shoebox's WritingJSONRollManager), and anything else as plain JSON
+lines."""
+
+import glob
+import gzip
+import json
+import logging
+
+from shoebox import archive
+from shoebox import disk_storage
+
+import yagi.config
+from yagi.broker import memory
+
+
+with yagi.config.defaults_for("replay_broker") as default:
+    default("path", "")
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _unwrap(payload):
+    # The shoebox handler can wrap notifications with region and cell.
+    if 'event_type' not in payload and 'notification' in payload:
+        return payload['notification']
+    return payload
+
+
+def read_json_lines(handle):
+    for line in handle:
+        line = line.strip()
+        if line:
+            yield _unwrap(json.loads(line))
+
+
+def read_shoebox_archive(filename):
+    reader = archive.ArchiveReader(filename)
+    try:
+        while True:
+            try:
+                metadata, raw = reader.read()
+            except disk_storage.EndOfFile:
+                break
+            yield _unwrap(json.loads(raw))
+    finally:
+        reader.close()
+
+
+def read_json_file(filename):
+    if filename.endswith(".gz"):
+        handle = gzip.open(filename, "rb")
+    else:
+        handle = open(filename, "r")
+    with handle:
+        for payload in read_json_lines(handle):
+            yield payload
+
+
+def read_file(filename):
+    LOG.info("Replaying notifications from %s" % filename)
+    if filename.endswith(".dat"):
+        return read_shoebox_archive(filename)
+    return read_json_file(filename)
+
+
+def read_files(paths):
+    for path in paths.split(","):
+        filenames = sorted(glob.glob(path.strip()))
+        if not filenames:
+            LOG.error("No replay files match %s" % path)
+        for filename in filenames:
+            for payload in read_file(filename):
+                yield payload
+
+
+class Broker(memory.Broker):
+    def source_for(self, consumer):
+        paths = consumer.config("replay_path") or \
+            yagi.config.get("replay_broker", "path")
+        if not paths:
+            LOG.error("Nothing to replay for %s" % consumer.queue_name)
+            return None
+        return read_files(paths)
@@ -0,0 +1,78 @@
+import time
+
+import yagi.stats
+
+
+class WeightedScheduler(object):
+    """Decides which consumer the broker fetches for next.
+
+    Work is handed out in rounds. Each round, a queue gets as many fetch
+    slots as its 'weight'. Queues with a higher 'priority' use up their
+    slots first; queues of equal priority are interleaved in proportion
+    to their weights. A queue that comes back empty gives up the rest of
+    its slots for the round, so idle queues don't hold anybody up.
+
+    A queue that hasn't been served for starvation_limit seconds goes
+    next, whatever its priority."""
+
+    def __init__(self, consumers, starvation_limit=0):
+        self.consumers = list(consumers)
+        self.starvation_limit = starvation_limit
+        self.weights = {}
+        self.priorities = {}
+        self.last_served = {}
+        now = time.time()
+        for consumer in self.consumers:
+            name = consumer.queue_name
+            self.weights[name] = max(1, int(consumer.config("weight",
+                                                            default=1)))
+            self.priorities[name] = int(consumer.config("priority",
+                                                        default=0))
+            self.last_served[name] = now
+        self.start_round()
+
+    def start_round(self):
+        self.remaining = dict(self.weights)
+        self.current = dict((name, 0) for name in self.weights)
+
+    def _starved(self, candidates, now):
+        if not self.starvation_limit:
+            return None
+        starved = [c for c in candidates
+                   if now - self.last_served[c.queue_name] >
+                      self.starvation_limit]
+        if not starved:
+            return None
+        return min(starved, key=lambda c: self.last_served[c.queue_name])
+
+    def next(self):
+        """The consumer to serve next, or None once the round is over."""
+        candidates = [c for c in self.consumers
+                      if self.remaining[c.queue_name] > 0]
+        if not candidates:
+            return None
+        now = time.time()
+        chosen = self._starved(candidates, now)
+        if chosen is None:
+            top = max(self.priorities[c.queue_name] for c in candidates)
+            candidates = [c for c in candidates
+                          if self.priorities[c.queue_name] == top]
+            # Smooth weighted round robin between equal priorities.
+            total = 0
+            for c in candidates:
+                self.current[c.queue_name] += self.weights[c.queue_name]
+                total += self.weights[c.queue_name]
+            chosen = max(candidates, key=lambda c: self.current[c.queue_name])
+            self.current[chosen.queue_name] -= total
+        name = chosen.queue_name
+        yagi.stats.time_stat(yagi.stats.queue_wait(name),
+                             now - self.last_served[name])
+        return chosen
+
+    def served(self, consumer, num_messages):
+        name = consumer.queue_name
+        self.last_served[name] = time.time()
+        if num_messages:
+            self.remaining[name] -= 1
+        else:
+            self.remaining[name] = 0
@@ -1,6 +1,7 @@
 import functools
 import logging
 import os
+import threading
 
 from contextlib import contextmanager
 from ConfigParser import SafeConfigParser, NoOptionError, NoSectionError
@@ -11,6 +12,9 @@ CONFIG_PATHS = ["/etc/yagi/", "./", "/etc/"]
 
 config = None
 config_path = None
+# Bumped every time the config is (re)loaded, so anything compiled from
+# it knows when to start over.
+generation = 0
 config_defaults = {'global': {'verbose': 'True',
                                'debug': 'False'},
                     # Defining defaults for this here, as it's usage is spread
@@ -23,6 +27,9 @@ config_defaults = {'global': {'verbose': 'True',
 
 filters = {}
 
+_reload_requested = threading.Event()
+_reload_lock = threading.Lock()
+
 
 class DefaultConfigParser(SafeConfigParser):
 
@@ -52,23 +59,54 @@ def setup(**kwargs):
 
 
 def parse_conf(path=None):
-    global config, config_path
-    config_path = path
-    config = DefaultConfigParser()
-    if not config_path:
+    global config, config_path, generation
+    if not path:
         for path in CONFIG_PATHS:
             path = path + CONFIG_FILE
             if os.path.exists(path):
-                config_path = path
                 break
+        else:
+            path = None
     else:
         if not os.path.exists(path):
             raise Exception("No configuration '%s' found" % path)
-    if config_path:
-        config.read(config_path)
+    # Read into a new parser and swap it in whole, so nothing ever sees
+    # a half read config.
+    new_config = DefaultConfigParser()
+    if path and not new_config.read(path):
+        raise Exception("Could not read configuration '%s'" % path)
+    config_path = path
+    config = new_config
+    generation += 1
     return config
 
 
+def request_reload(signum=None, frame=None):
+    """SIGHUP handler. The reload itself happens between batches, see
+    reload_if_requested."""
+    _reload_requested.set()
+
+
+def reload_if_requested():
+    """Re-reads the config file if a reload was requested. Returns True
+    if a new config was swapped in. A config that doesn't parse is
+    logged and the current one kept."""
+    LOG = logging.getLogger(__name__)
+    if not _reload_requested.is_set():
+        return False
+    with _reload_lock:
+        if not _reload_requested.is_set():
+            return False
+        _reload_requested.clear()
+        try:
+            parse_conf(config_path)
+        except Exception as e:
+            LOG.error("Not reloading configuration: %s" % e)
+            return False
+    LOG.info("Reloaded configuration from %s" % config_path)
+    return True
+
+
 def defaults(section, option, value):
     section_defaults = config_defaults.get(section) or dict()
     section_defaults[option] = str(value)
@@ -111,3 +149,77 @@ def get_bool(*args, **kwargs):
 
 def config_with(*args):
     return functools.partial(get, *args)
+
+
+_BOOLEAN_STATES = SafeConfigParser._boolean_states
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    try:
+        return _BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError("Not a boolean: %s" % value)
+
+
+def _to_list(value):
+    return tuple(v.strip() for v in value.split(",") if v.strip())
+
+
+class Settings(object):
+    """Typed, cached lookups of options from a list of sections, the
+    first section that has an option winning.
+
+    Each option is looked up and converted the first time it's asked
+    for, and served from a dict after that, until the config is
+    reloaded (see generation). Code that reads its options per message
+    or per batch can use this rather than going through ConfigParser
+    every time."""
+
+    def __init__(self, *sections):
+        self.sections = sections
+        self._values = {}
+        self._generation = None
+
+    def _lookup(self, key, convert):
+        if self._generation != generation:
+            # A fresh dict rather than clearing it, as other threads
+            # may be reading it.
+            self._values = {}
+            self._generation = generation
+        values = self._values
+        try:
+            return values[(key, convert)]
+        except KeyError:
+            pass
+        value = None
+        for section in self.sections:
+            value = get(section, key)
+            if value is not None:
+                break
+        if value is not None and convert is not None:
+            value = convert(value)
+        values[(key, convert)] = value
+        return value
+
+    def _get(self, key, convert, default):
+        value = self._lookup(key, convert)
+        if value is None:
+            return default
+        return value
+
+    def get(self, key, default=None):
+        return self._get(key, None, default)
+
+    def get_int(self, key, default=None):
+        return self._get(key, int, default)
+
+    def get_float(self, key, default=None):
+        return self._get(key, float, default)
+
+    def get_bool(self, key, default=None):
+        return self._get(key, _to_bool, default)
+
+    def get_list(self, key, default=()):
+        return self._get(key, _to_list, default)
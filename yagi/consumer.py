@@ -1,9 +1,15 @@
 import datetime
 import logging
 import time
+import weakref
 
 import yagi.config
+import yagi.dedup
 import yagi.filters
+import yagi.handler.parallel
+import yagi.handler.pipeline
+import yagi.handler.routing
+import yagi.shutdown
 import yagi.stats
 import yagi.utils
 
@@ -11,26 +17,150 @@ import yagi.utils
 LOG = logging.getLogger(__name__)
 
 
+def message_id(message):
+    try:
+        return message.message_id
+    except AttributeError:
+        return message.payload.get('message_id')
+
+
+class BatchSizer(object):
+    """Picks the number of messages to fetch per batch, between min_size
+    and max_size, aiming for the handler chain to take about target_time
+    seconds per batch.
+
+    The size shrinks as soon as batches run long. It only grows when the
+    last batch was full, as a partial batch means the queue can't keep
+    a bigger batch filled anyway."""
+
+    def __init__(self, min_size, max_size, target_time):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.target_time = target_time
+        self.size = self.max_size
+
+    def update(self, num_messages, elapsed):
+        if not num_messages:
+            return self.size
+        per_message = elapsed / num_messages
+        if per_message > 0:
+            ideal = int(self.target_time / per_message)
+        else:
+            ideal = self.max_size
+        if ideal < self.size:
+            self.size = max(self.min_size, ideal)
+        elif num_messages >= self.size:
+            # Grow gradually, halfway towards the ideal size each batch.
+            step = max(1, (ideal - self.size) // 2)
+            self.size = min(self.max_size, self.size + step)
+        return self.size
+
+
+class AckTracker(object):
+    """The delivery tags settled on one channel, so a multiple ack is
+    only sent when it can't settle anything but the messages meant.
+
+    Tags on a channel count up from 1. Every tag up to 'watermark' is
+    settled, 'settled' holds the settled tags above it."""
+
+    # Past this many unsettled tags, acks go one by one rather than
+    # checking them all.
+    MAX_SPAN = 10000
+
+    def __init__(self):
+        self.watermark = 0
+        self.settled = set()
+
+    def settle(self, tag):
+        if tag <= self.watermark:
+            return
+        self.settled.add(tag)
+        while self.watermark + 1 in self.settled:
+            self.watermark += 1
+            self.settled.discard(self.watermark)
+
+    def covers(self, tags):
+        """True if tags are all the unsettled tags up to the highest."""
+        tags = set(tags)
+        last = max(tags)
+        if last - self.watermark > self.MAX_SPAN:
+            return False
+        for tag in xrange(self.watermark + 1, last + 1):
+            if tag not in tags and tag not in self.settled:
+                return False
+        return True
+
+
+def _channel(message):
+    return getattr(getattr(message, 'backend', None), 'channel', None)
+
+
 class Consumer(object):
     def __init__(self, queue_name, app=None, config=None):
-        self.filters = []
         self.queue_name = queue_name
         self.config = yagi.config.config_with("consumer:%s" % queue_name)
         self.connect_time = None
         self.connection = None
         self.consumer = None
+        # Shared counter set by the event worker pool, see
+        # yagi.event_worker.WorkerPool.
+        self.messages_counter = None
+        self.ack_trackers = weakref.WeakKeyDictionary()
         apps = [a.strip() for a in self.config("apps").split(",")]
+        self.parallel_apps = self.config("parallel_apps") == "True"
+        pipeline = self.config("pipeline") == "True"
+        self.handlers = []
         prev_app = None
         for a in apps:
+            if self.parallel_apps or pipeline:
+                prev_app = None
             prev_app = yagi.utils.import_class(a)(prev_app,
                                                 queue_name=self.queue_name)
-        self.app = prev_app
+            self.handlers.append(prev_app)
+        self.routing_table = yagi.handler.routing.RoutingTable(
+                                    h.CONFIG_SECTION for h in self.handlers)
+        self.pipeline = None
+        if pipeline:
+            self.pipeline = yagi.handler.pipeline.Pipeline(
+                self.handlers, self.stage_workers,
+                int(self.config("stage_queue_size", default=10)))
+            self.app = self.pipeline
+        elif self.parallel_apps:
+            self.app = yagi.handler.parallel.ParallelChain(self.handlers)
+        else:
+            self.app = prev_app
+        # 'auto' leaves acking to AUTO_ACK handlers, one message at a time.
+        # 'batch' acks the whole batch once the handler chain is done.
+        # Parallel handlers and pipeline stages can't ack as they go, as
+        # the channel isn't safe to use from several threads at once.
+        self.batch_ack = (self.config("ack_policy") == "batch" or
+                          self.parallel_apps or pipeline)
+        self.dedup_cache = None
+        if self.config("dedup") == "True":
+            self.dedup_cache = yagi.dedup.dedup_cache(self.queue_name)
+        self.configure()
+
+    def configure(self):
+        """Reads the settings that a config reload can change without
+        restarting: batch sizes and latency, and payload filters. The
+        handlers pick up theirs on their own, see yagi.config.Settings.
+        Changing apps, pipeline, parallel_apps, ack_policy or dedup still
+        needs a restart."""
+        self.generation = yagi.config.generation
         self.max_messages = int(self.config("max_messages"))
+        self.max_batch_latency = float(
+            self.config("max_batch_latency_ms", default=0)) / 1000
+        self.batch_sizer = None
+        if self.config("adaptive_batching") == "True":
+            self.batch_sizer = BatchSizer(
+                int(self.config("min_messages", default=1)),
+                self.max_messages,
+                float(self.config("target_batch_time", default=5)))
 
+        filters = []
         filter_names = self.config("filters")
         if filter_names:
-            filters = (f.strip() for f in filter_names.split(","))
-            for f in filters:
+            for f in (f.strip() for f in filter_names.split(",")):
                 section = yagi.config.config_with("filter:%s" % f)
                 map_file = section("map_file")
                 method = section("method")
@@ -39,7 +169,70 @@ class Consumer(object):
                     # Since these should go away, I don't know that it's a big
                     # deal if we can't find one
                     continue
-                self.filters.append(filter_class)
+                filters.append(filter_class)
+        self.filters = filters
+
+    def refresh_config(self):
+        """Re-reads the settings in configure() if the config has been
+        reloaded since."""
+        if self.generation != yagi.config.generation:
+            LOG.info("Configuration reloaded, updating %s" % self.queue_name)
+            self.configure()
+
+    def stage_workers(self, handler):
+        """Worker threads for a handler's pipeline stage, from the
+        handler's pipeline_workers option or the consumer's
+        stage_workers."""
+        return int(handler.config_get("pipeline_workers",
+                   default=self.config("stage_workers", default=1)))
+
+    def filtered_event_types(self):
+        """The event types some handler in the chain will process, going by
+        the [filters] and [exclude_filters] config, or None if any handler
+        takes every event type."""
+        wanted = set()
+        for handler in self.handlers:
+            include, exclude = handler.event_type_filters()
+            if not include:
+                return None
+            wanted.update(set(include) - set(exclude))
+        return sorted(wanted)
+
+    def bindings(self):
+        """(routing_key, arguments) pairs to bind the queue with, or None
+        to bind it with the configured routing_key as usual.
+
+        With filter_bindings set, the queue is only bound for the event
+        types the handler filters let through, so the broker drops the
+        rest before they ever reach yagi. 'routing_key' binds once per
+        event type with the filter_routing_key template, for publishers
+        that route by event type. 'headers' matches on an event_type
+        message header, for headers exchanges."""
+        mode = self.config("filter_bindings")
+        if not mode:
+            return None
+        event_types = self.filtered_event_types()
+        if event_types is None:
+            LOG.warn("Not all handlers for %s filter by event type, "
+                     "binding with routing key %s" %
+                     (self.queue_name, self.config("routing_key")))
+            return None
+        globs = [e for e in event_types if yagi.handler.routing.has_glob(e)]
+        if globs:
+            LOG.warn("Filters for %s use glob patterns (%s), which can't be "
+                     "bound, binding with routing key %s" %
+                     (self.queue_name, ", ".join(globs),
+                      self.config("routing_key")))
+            return None
+        if mode == "headers":
+            return [("", {"x-match": "all", "event_type": event_type})
+                    for event_type in event_types]
+        template = self.config("filter_routing_key",
+                               default="%(event_type)s")
+        routing_key = self.config("routing_key")
+        return [(template % dict(event_type=event_type,
+                                 routing_key=routing_key), None)
+                for event_type in event_types]
 
     def connect(self, connection, consumer):
         self.disconnect()
@@ -63,19 +256,196 @@ class Consumer(object):
         except Exception as e:
             LOG.exception("Error in idle(): \n%s" % e)
 
+    def shutdown(self):
+        try:
+            self.app.shutdown()
+        except Exception as e:
+            LOG.exception("Error in shutdown(): \n%s" % e)
+        self.ack_finished()
+        self.disconnect()
+
+    def failed_message_ids(self, env):
+        """Message ids the handlers recorded as errors in their results."""
+        failed = set()
+        for key, results in env.iteritems():
+            if key.endswith('.results') and isinstance(results, dict):
+                failed.update(msgid for msgid, result in results.iteritems()
+                              if result.get('error'))
+        return failed
+
+    def ack_tracker(self, channel):
+        tracker = self.ack_trackers.get(channel)
+        if tracker is None:
+            tracker = AckTracker()
+            self.ack_trackers[channel] = tracker
+        return tracker
+
+    def settled(self, message):
+        channel = _channel(message)
+        if channel is not None:
+            self.ack_tracker(channel).settle(message.delivery_tag)
+
+    def settle(self, message, method):
+        """Acks, rejects or requeues a message, keeping track of the
+        delivery tags settled on its channel."""
+        getattr(message, method)()
+        self.settled(message)
+
+    def ack_messages(self, messages):
+        pending = [m for m in messages if not m.acknowledged]
+        if not pending:
+            return
+        last = max(pending, key=lambda m: m.delivery_tag)
+        channel = _channel(last)
+        if (channel is None or len(pending) == 1 or
+                any(_channel(m) is not channel for m in pending) or
+                not self.ack_tracker(channel).covers(
+                    m.delivery_tag for m in pending)):
+            for message in pending:
+                self.settle(message, 'ack')
+            return
+        # One frame acks every outstanding delivery up to the last tag,
+        # which are exactly the pending ones.
+        channel.basic_ack(last.delivery_tag, multiple=True)
+        for message in pending:
+            # Keep carrot's idea of the message state in sync.
+            message._state = "ACK"
+            self.settled(message)
+
+    def ack_batch(self, messages, env):
+        """Rejects messages the handlers reported errors for, and acks the
+        rest with a single multiple ack."""
+        failed_ids = self.failed_message_ids(env)
+        done = []
+        for message in messages:
+            if message.acknowledged:
+                self.settled(message)
+                continue
+            if failed_ids and message_id(message) in failed_ids:
+                self.settle(message, 'reject')
+            else:
+                done.append(message)
+        self.ack_messages(done)
+
+    def drop_duplicates(self, messages):
+        """Acks and drops messages that already made it through the
+        handler chain, as happens when RabbitMQ redelivers unacked
+        messages after a reconnect."""
+        ids = [message_id(m) for m in messages]
+        seen = self.dedup_cache.seen([i for i in ids if i])
+        if not seen:
+            return messages
+        fresh = []
+        duplicates = []
+        for message, msgid in zip(messages, ids):
+            if msgid in seen:
+                duplicates.append(message)
+            else:
+                fresh.append(message)
+        LOG.info("Dropping %d redelivered messages on %s" %
+                 (len(duplicates), self.queue_name))
+        # One by one, as a multiple ack would take fresh messages with
+        # lower tags along with it.
+        for message in duplicates:
+            if not message.acknowledged:
+                self.settle(message, 'ack')
+        yagi.stats.increment_stat(yagi.stats.dedup_hits(self.queue_name),
+                                  len(duplicates))
+        return fresh
+
+    def record_delivered(self, messages, env):
+        failed_ids = self.failed_message_ids(env)
+        ids = [message_id(m) for m in messages]
+        self.dedup_cache.add([i for i in ids if i and i not in failed_ids])
+
+    def requeue_messages(self, messages):
+        for message in messages:
+            if not message.acknowledged:
+                self.settle(message, 'requeue')
+
+    def ack_finished(self):
+        """Acks the batches the pipeline is done with. This has to happen
+        on the thread that owns the AMQP channel, so the brokers call it
+        between fetches."""
+        if self.pipeline is None:
+            return
+        for messages, env in self.pipeline.take_finished():
+            error = env.get('yagi.pipeline_error')
+            if error is not None:
+                LOG.error("Requeueing batch on %s after pipeline error: %s" %
+                          (self.queue_name, error))
+                self.requeue_messages(messages)
+                continue
+            yagi.stats.time_stat(yagi.stats.elapsed_message(),
+                                 time.time() - env['yagi.start_time'])
+            self.ack_batch(messages, env)
+            if self.dedup_cache is not None:
+                self.record_delivered(messages, env)
+
+    def wait_finished(self):
+        """Waits for the pipeline to finish every batch it was given, and
+        acks them."""
+        if self.pipeline is None:
+            return
+        while self.pipeline.busy():
+            time.sleep(0.01)
+        self.ack_finished()
+
     def fetched_messages(self, messages):
+        if self.dedup_cache is not None:
+            messages = self.drop_duplicates(messages)
+            if not messages:
+                return
         if self.filters:
             env = {'yagi.filters': self.filters}
         else:
             env = {}
+        if self.batch_ack:
+            env['yagi.batch_ack'] = True
+        start_time = time.time()
+        try:
+            env['yagi.routes'] = self.routing_table.route(messages)
+        except Exception, e:
+            # Leave it to the handlers to filter, and fail, for themselves.
+            LOG.exception("Error routing messages on %s: %s" %
+                          (self.queue_name, e))
+        if self.pipeline is not None:
+            env['yagi.start_time'] = start_time
+            # Acked by ack_finished() once the last stage is done with it.
+            self.pipeline(messages, env=env)
+            self.count_messages(messages)
+            return
         try:
-            start_time = time.time()
             self.app(messages, env=env)
             yagi.stats.time_stat(yagi.stats.elapsed_message(),
                                  time.time() - start_time)
+        except yagi.shutdown.ShutdownRequested, e:
+            LOG.warn("Batch on %s interrupted by shutdown, unacked messages "
+                     "will be redelivered: %s" % (self.queue_name, e))
+            if self.batch_ack:
+                self.requeue_messages(messages)
         except Exception, e:
             # If we get all the way back out here, that's bad juju
             LOG.exception("Error in fetched_messages: \n%s" % e)
+            if self.batch_ack:
+                self.requeue_messages(messages)
+        else:
+            if self.batch_ack:
+                self.ack_batch(messages, env)
+            if self.dedup_cache is not None:
+                self.record_delivered(messages, env)
+
+        if self.batch_sizer:
+            self.max_messages = self.batch_sizer.update(
+                len(messages), time.time() - start_time)
+            yagi.stats.gauge_stat(yagi.stats.batch_size(self.queue_name),
+                                  self.max_messages)
+
+        self.count_messages(messages)
 
+    def count_messages(self, messages):
         yagi.stats.increment_stat(yagi.stats.messages_sent(),
                                   len(messages))
+        if self.messages_counter is not None:
+            with self.messages_counter.get_lock():
+                self.messages_counter.value += len(messages)
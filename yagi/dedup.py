@@ -0,0 +1,145 @@
+"""Remembers which messages have already made it through the handler chain,
+so redeliveries after a reconnect can be dropped instead of sent again."""
+
+import collections
+import logging
+import os
+
+import yagi.config
+import yagi.utils
+
+with yagi.config.defaults_for('dedup') as default:
+    default('size', 10000)
+    default('store', '')
+    default('host', 'localhost')
+    default('port', 6379)
+    default('password', '')
+    default('ttl', 60 * 60 * 24)
+    default('path', '/var/lib/yagi/dedup')
+
+
+LOG = logging.getLogger(__name__)
+
+
+class RedisStore(object):
+    """Shares delivered message ids between yagi workers via Redis. Ids
+    expire after [dedup] ttl seconds."""
+
+    def __init__(self, queue_name, size):
+        import redis
+
+        conf = yagi.config.config_with('dedup')
+        self.ttl = int(conf('ttl'))
+        self.prefix = 'dedup:%s:' % queue_name
+        self.client = redis.Redis(host=conf('host'),
+                                  password=conf('password'),
+                                  port=int(conf('port')))
+
+    def recent(self):
+        return []
+
+    def seen(self, message_ids):
+        pipe = self.client.pipeline()
+        for message_id in message_ids:
+            pipe.exists(self.prefix + message_id)
+        return set(message_id for message_id, found in
+                   zip(message_ids, pipe.execute()) if found)
+
+    def add(self, message_ids):
+        pipe = self.client.pipeline()
+        for message_id in message_ids:
+            pipe.set(self.prefix + message_id, 1, ex=self.ttl)
+        pipe.execute()
+
+
+class FileStore(object):
+    """Appends delivered message ids to a file per queue under
+    [dedup] path, so the cache survives a restart. The file is cut back
+    to the last 'size' ids once it grows to twice that."""
+
+    def __init__(self, queue_name, size):
+        directory = yagi.config.get('dedup', 'path')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, queue_name)
+        self.size = size
+        self.lines = 0
+
+    def recent(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            message_ids = [line.strip() for line in f if line.strip()]
+        self.lines = len(message_ids)
+        return message_ids[-self.size:]
+
+    def seen(self, message_ids):
+        # Everything in the file was loaded into the cache at startup.
+        return set()
+
+    def add(self, message_ids):
+        with open(self.path, 'a') as f:
+            for message_id in message_ids:
+                f.write('%s\n' % message_id)
+        self.lines += len(message_ids)
+        if self.lines >= self.size * 2:
+            self.compact()
+
+    def compact(self):
+        message_ids = self.recent()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for message_id in message_ids:
+                f.write('%s\n' % message_id)
+        os.rename(tmp, self.path)
+        self.lines = len(message_ids)
+
+
+class DedupCache(object):
+    """A bounded LRU of delivered message ids, in front of an optional
+    store that keeps them beyond this process."""
+
+    def __init__(self, size, store=None):
+        self.size = size
+        self.store = store
+        self.cache = collections.OrderedDict()
+        if store:
+            self._remember(store.recent())
+
+    def _remember(self, message_ids):
+        for message_id in message_ids:
+            self.cache.pop(message_id, None)
+            self.cache[message_id] = True
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def seen(self, message_ids):
+        """The subset of message_ids that were already delivered."""
+        found = set(m for m in message_ids if m in self.cache)
+        missing = [m for m in message_ids if m not in found]
+        if self.store and missing:
+            try:
+                found.update(self.store.seen(missing))
+            except Exception, e:
+                LOG.exception("Error checking dedup store: %s" % e)
+        self._remember(found)
+        return found
+
+    def add(self, message_ids):
+        if not message_ids:
+            return
+        self._remember(message_ids)
+        if self.store:
+            try:
+                self.store.add(message_ids)
+            except Exception, e:
+                LOG.exception("Error updating dedup store: %s" % e)
+
+
+def dedup_cache(queue_name):
+    conf = yagi.config.config_with('dedup')
+    size = int(conf('size'))
+    store = None
+    if conf('store'):
+        store = yagi.utils.import_class(conf('store'))(queue_name, size)
+    return DedupCache(size, store)
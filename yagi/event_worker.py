@@ -1,5 +1,11 @@
 import logging
+import multiprocessing
+import os
+import signal
+import time
+
 import yagi.config
+import yagi.shutdown
 import yagi.utils
 
 LOG = logging.getLogger(__name__)
@@ -8,11 +14,159 @@ with yagi.config.defaults_for('event_worker') as default:
     default('pidfile', 'yagi_event_worker.pid')
     default('daemonize', 'False')
     default('event_driver', 'yagi.broker.rabbit.Broker')
+    default('worker_pool', 'False')
+    default('processes', 1)
+    default('restart_delay', 5)
+    default('shutdown_timeout', 30)
 
 
-def start(consumers):
+def _run_broker(consumers):
     broker = yagi.utils.import_class(yagi.config.get('event_worker',
                                                      'event_driver'))()
     for consumer in consumers:
         broker.add_consumer(consumer)
     broker.loop()
+
+
+def _run_worker(consumer, counter):
+    # The supervisor handles SIGINT, the children shouldn't inherit it.
+    # It stops the children with SIGTERM, which they drain on.
+    yagi.shutdown.install()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, yagi.config.request_reload)
+    # Restart interrupted system calls, so a reload doesn't fail a socket
+    # read or write in progress with EINTR.
+    signal.siginterrupt(signal.SIGHUP, False)
+    consumer.messages_counter = counter
+    _run_broker([consumer])
+
+
+class WorkerPool(object):
+    """Runs each consumer in its own set of worker processes.
+
+    The number of processes per queue comes from 'processes' in the
+    consumer's section (falling back to [event_worker]). Crashed workers
+    are restarted, no more often than every restart_delay seconds per
+    slot. Message counts from all of a queue's workers are collected in
+    shared memory and reported every update_timer seconds."""
+
+    def __init__(self, consumers):
+        self.consumers = consumers
+        self.slots = []
+        self.counters = {}
+        for consumer in consumers:
+            processes = int(consumer.config("processes",
+                default=yagi.config.get('event_worker', 'processes')))
+            self.counters[consumer.queue_name] = multiprocessing.Value('L',
+                                                                       0)
+            for n in xrange(max(processes, 1)):
+                self.slots.append(dict(consumer=consumer, index=n,
+                                       process=None, started=None,
+                                       died=0))
+        self.running = False
+
+    def spawn(self, slot):
+        consumer = slot['consumer']
+        process = multiprocessing.Process(
+            target=_run_worker,
+            name="yagi-%s-%d" % (consumer.queue_name, slot['index']),
+            args=(consumer, self.counters[consumer.queue_name]))
+        process.start()
+        slot['process'] = process
+        slot['started'] = time.time()
+        LOG.info("Started worker %s (pid %s)" % (process.name, process.pid))
+
+    def check_workers(self):
+        restart_delay = float(yagi.config.get('event_worker',
+                                              'restart_delay'))
+        for slot in self.slots:
+            process = slot['process']
+            if process is not None and process.is_alive():
+                continue
+            if process is not None and slot['started'] is not None:
+                LOG.error("Worker %s exited with code %s" %
+                          (process.name, process.exitcode))
+                slot['started'] = None
+                slot['died'] = time.time()
+            if time.time() - slot['died'] >= restart_delay:
+                self.spawn(slot)
+
+    def take_messages_sent(self):
+        messages_sent = {}
+        for queue_name, counter in self.counters.iteritems():
+            with counter.get_lock():
+                messages_sent[queue_name] = counter.value
+                counter.value = 0
+        return messages_sent
+
+    def report(self, elapsed):
+        messages_sent = self.take_messages_sent()
+        LOG.info("Update timer elapsed: %s seconds", str(elapsed))
+        total_messages = 0
+        for consumer in self.consumers:
+            sent = messages_sent[consumer.queue_name]
+            LOG.info("\tSent %d messages from %s" % (sent,
+                                                     consumer.queue_name))
+            total_messages += sent
+        LOG.info("\tSent %d total messages" % total_messages)
+        if total_messages > 0:
+            LOG.info("\tMessages per second: %f" %
+                     (float(total_messages) / elapsed))
+
+    def reload(self, signum=None, frame=None):
+        """Passes SIGHUP on to the workers. The config is reloaded here
+        too, so workers restarted from now on start out with it."""
+        yagi.config.request_reload()
+        for slot in self.slots:
+            process = slot['process']
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def shutdown(self):
+        timeout = float(yagi.config.get('event_worker', 'shutdown_timeout'))
+        processes = [s['process'] for s in self.slots
+                     if s['process'] is not None and s['process'].is_alive()]
+        for process in processes:
+            process.terminate()
+        deadline = time.time() + timeout
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                LOG.error("Worker %s did not stop, killing it" %
+                          process.name)
+                os.kill(process.pid, signal.SIGKILL)
+        LOG.info("All workers stopped")
+
+    def run(self):
+        update_timer = int(yagi.config.get('global', 'update_timer',
+                                           default=300))
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        signal.siginterrupt(signal.SIGHUP, False)
+        start_time = time.time()
+        while self.running:
+            if yagi.config.reload_if_requested():
+                for consumer in self.consumers:
+                    consumer.refresh_config()
+            self.check_workers()
+            elapsed = int(time.time() - start_time)
+            if elapsed > update_timer:
+                self.report(elapsed)
+                start_time = time.time()
+            time.sleep(1)
+        self.shutdown()
+
+
+def start(consumers):
+    if yagi.config.get('event_worker', 'worker_pool') == 'True':
+        WorkerPool(consumers).run()
+    else:
+        yagi.shutdown.install()
+        signal.signal(signal.SIGHUP, yagi.config.request_reload)
+        signal.siginterrupt(signal.SIGHUP, False)
+        _run_broker(consumers)
@@ -1,92 +1,219 @@
+"""Payload filters, configured in [filter:<name>] sections.
+
+Each filter's map_file is compiled once, when the filter is created, into
+a list of key paths into the payload, along with what to do with the
+value found there. Filtering a payload then only looks up the mapped
+keys, rather than walking the whole mapping for every message. Filters
+are shared by every consumer using the same method and map_file (see
+get_filter)."""
+
 import datetime
 import dateutil.parser
 import json
+import re
+
+import yagi.config
+import yagi.stats
+
+
+_filters = {}
+_filters_generation = None
+
+
+def _lookup(message, path):
+    """(the dict holding the last key of path, the value there), or
+    (None, None) if the message has no value there, or an empty one."""
+    node = message
+    for key in path[:-1]:
+        if not isinstance(node, dict):
+            return None, None
+        node = node.get(key)
+    if not isinstance(node, dict):
+        return None, None
+    value = node.get(path[-1])
+    if not value:
+        return None, None
+    return node, value
+
+
+def _leaves(mapping, path=()):
+    """(key path, value) for every non-dict value in a nested mapping."""
+    for k, v in mapping.iteritems():
+        if isinstance(v, dict):
+            for leaf in _leaves(v, path + (k,)):
+                yield leaf
+        else:
+            yield path + (k,), v
+
+
+def _datetime(match):
+    year, month, day, hour, minute, second, fraction = match.groups()
+    microsecond = int(fraction.ljust(6, "0")) if fraction else 0
+    return datetime.datetime(int(year), int(month), int(day), int(hour),
+                             int(minute), int(second), microsecond)
+
+
+def _date(match):
+    year, month, day = match.groups()
+    return datetime.datetime(int(year), int(month), int(day))
+
+
+# The timestamp formats OpenStack sends, e.g. 2013-01-01 23:30:00,
+# 2013-01-01T23:30:00.123456 or 2013-01-01T23:30:00Z, with a parser for
+# each. Zone offsets are dropped, as they are from the shifted timestamp
+# anyway. Anything else is left to dateutil.
+TIMESTAMP_FORMATS = [
+    (re.compile(r"(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)"
+                r"(?:\.(\d{1,6}))?(?:Z|[+-]\d\d:?\d\d)?$"), _datetime),
+    (re.compile(r"(\d{4})-(\d\d)-(\d\d)$"), _date),
+]
+
+
+def _unicode(value):
+    if isinstance(value, unicode):
+        return value
+    return unicode(value)
 
 
 class FilterMessage(object):
+    """Replaces the values at the map's key paths with the map's
+    values."""
+
     def __init__(self, map_file, logger):
         self.log = logger
         self.log.info("Initializing Filter: %s with Map: %s" %
                 (self.__class__.__name__, map_file))
         with open(map_file, 'r') as f:
             self.transform_dict = json.load(f)
+        self.paths = self.compile(self.transform_dict)
 
-    def transform(self, mapping, message):
-        for k, v in mapping.iteritems():
-            if isinstance(message, dict) and message.get(k):
-                if isinstance(message[k], dict):
-                    self.transform(v, message[k])
-                else:
-                    message[k] = v
-        return message
+    def compile(self, mapping):
+        return list(_leaves(mapping))
 
     def __call__(self, message):
-        return self.transform(self.transform_dict, message)
+        for path, replacement in self.paths:
+            node, value = _lookup(message, path)
+            if node is not None and not isinstance(value, dict):
+                node[path[-1]] = replacement
+        return message
 
 
 class FilterMessageMatch(FilterMessage):
-    def transform(self, mapping, message):
+    """Translates the values at the map's key paths.
+
+    A list in the map holds lookup dicts, tried in order, for the value
+    there. A dict in the map translates the value there, if it isn't
+    itself a dict, as a lookup dict of its own."""
+
+    def compile(self, mapping, path=()):
+        paths = []
         for k, v in mapping.iteritems():
-            if isinstance(message, dict) and message.get(k):
-                if isinstance(v, dict):
-                    message[k] = self.transform(v, message[k])
-                elif isinstance(v, list):
-                    for match_dict in v:
-                        if match_dict.get(unicode(message[k])):
-                            message[k] = match_dict[unicode(message[k])]
-                            break
-            else:
-                if unicode(k) == message:
-                    return v
+            key_path = path + (k,)
+            if isinstance(v, dict):
+                paths.extend(self.compile(v, key_path))
+                # After the nested paths, so they don't go on to look
+                # inside whatever this puts in place of the value.
+                if v:
+                    paths.append((key_path, dict(v), None))
+            elif isinstance(v, list):
+                table = {}
+                for match_dict in v:
+                    for match, replacement in match_dict.iteritems():
+                        # Earlier lookup dicts take precedence.
+                        if replacement and match not in table:
+                            table[match] = replacement
+                if table:
+                    paths.append((key_path, table, _unicode))
+        return paths
+
+    def __call__(self, message):
+        for path, table, to_key in self.paths:
+            node, value = _lookup(message, path)
+            if node is None or isinstance(value, dict):
+                continue
+            try:
+                key = to_key(value) if to_key else value
+                node[path[-1]] = table[key]
+            except (KeyError, TypeError):
+                pass
         return message
 
 
 class FilterMessageTimestamp(FilterMessage):
-    def transform(self, mapping, message):
-        for k, v in mapping.iteritems():
-            if isinstance(message, dict) and message.get(k):
-                if isinstance(message[k], dict):
-                    self.transform(v, message[k])
-                else:
-                    try:
-                        audit = dateutil.parser.parse(message[k])
-                        delta = datetime.timedelta(hours=int(v))
-                        offset = audit + delta
-
-                        message[k] = offset.strftime("%Y-%m-%d %H:%M:%S.%f")
-                    except Exception, e:
-                        # log the exception, but there still could be other
-                        # keys to convert
-                        self.log.error("Bad timestamp in message: %s" %
-                                                message[k])
-                        self.log.exception(e)
-        return message
+    """Shifts the timestamps at the map's key paths by the map's number
+    of hours.
 
+    Each key path remembers which of TIMESTAMP_FORMATS its timestamps
+    came in last, and tries that one first. Timestamps in none of them
+    go to dateutil, counted by the yagi.timestamp_fallbacks stat."""
 
-class FilterMessageTimestampForUsageRetards(FilterMessage):
-    def transform(self, mapping, message):
-        for k, v in mapping.iteritems():
-            if isinstance(message, dict) and message.get(k):
-                if isinstance(message[k], dict):
-                    self.transform(v, message[k])
-                else:
-                    try:
-                        audit = dateutil.parser.parse(message[k])
-                        delta = datetime.timedelta(hours=int(v))
-                        offset = audit + delta
-
-                        message[k] = offset.strftime("%Y-%m-%dT%H:%M:%S.%f")
-                    except Exception, e:
-                        # log the exception, but there still could be other
-                        # keys to convert
-                        self.log.error("Bad timestamp in message: %s" %
-                                                message[k])
-                        self.log.exception(e)
+    TIMESTAMP_FORMAT = "%04d-%02d-%02d %02d:%02d:%02d.%06d"
+
+    def compile(self, mapping):
+        self.formats = {}
+        self.fallbacks = 0
+        paths = []
+        for path, hours in _leaves(mapping):
+            try:
+                paths.append((path, datetime.timedelta(hours=int(hours))))
+            except (TypeError, ValueError):
+                self.log.error("Bad hour offset for %s: %s" %
+                               (".".join(path), hours))
+        return paths
+
+    def parse(self, path, value):
+        if isinstance(value, basestring):
+            formats = self.formats.get(path, TIMESTAMP_FORMATS)
+            for timestamp_format in formats:
+                regex, parser = timestamp_format
+                match = regex.match(value)
+                if match is not None:
+                    if timestamp_format is not formats[0]:
+                        self.formats[path] = [timestamp_format] + \
+                            [f for f in TIMESTAMP_FORMATS
+                             if f is not timestamp_format]
+                    return parser(match)
+        self.fallbacks += 1
+        yagi.stats.increment_stat(yagi.stats.timestamp_fallbacks())
+        return dateutil.parser.parse(value)
+
+    def __call__(self, message):
+        for path, delta in self.paths:
+            node, value = _lookup(message, path)
+            if node is None or isinstance(value, dict):
+                continue
+            try:
+                offset = self.parse(path, value) + delta
+
+                node[path[-1]] = self.TIMESTAMP_FORMAT % (
+                    offset.year, offset.month, offset.day, offset.hour,
+                    offset.minute, offset.second, offset.microsecond)
+            except Exception, e:
+                # log the exception, but there still could be other
+                # keys to convert
+                self.log.error("Bad timestamp in message: %s" % value)
+                self.log.exception(e)
         return message
 
 
+class FilterMessageTimestampForUsageRetards(FilterMessageTimestamp):
+    TIMESTAMP_FORMAT = "%04d-%02d-%02dT%02d:%02d:%02d.%06d"
+
+
 def get_filter(filter_name, map_file, logger):
+    """The filter_name filter for map_file. Map files are compiled once
+    per config generation, and the filter shared by every consumer that
+    uses it."""
+    global _filters_generation
     if not filter_name in globals():
         logger.exception("No filter named %s" % filter_name)
         return None
-    return globals()[filter_name](map_file, logger)
+    if _filters_generation != yagi.config.generation:
+        _filters.clear()
+        _filters_generation = yagi.config.generation
+    key = (filter_name, map_file)
+    message_filter = _filters.get(key)
+    if message_filter is None:
+        message_filter = globals()[filter_name](map_file, logger)
+        _filters[key] = message_filter
+    return message_filter
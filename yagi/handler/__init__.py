@@ -1,6 +1,12 @@
 from ConfigParser import NoSectionError, NoOptionError
 import logging
+import time
+
 import yagi.config
+import yagi.stats
+from yagi.handler import delivery
+from yagi.handler import routing
+from yagi.handler.routing import event_type
 
 
 LOG = logging.getLogger(__name__)
@@ -14,45 +20,53 @@ class BaseHandler(object):
         self.app = app
         self.queue_name = queue_name
 
+    @property
+    def settings(self):
+        """This handler's options, from [<section>:<queue>] then
+        [<section>]. Looked up once per config generation and cached,
+        see yagi.config.Settings."""
+        settings = self.__dict__.get('_settings')
+        if settings is None:
+            sections = [self.CONFIG_SECTION]
+            if self.queue_name is not None:
+                sections.insert(0, "%s:%s" % (self.CONFIG_SECTION,
+                                              self.queue_name))
+            settings = yagi.config.Settings(*sections)
+            self._settings = settings
+        return settings
+
     def config_get(self, key, default=None):
-        return self._config_get(yagi.config.get, key, default=default)
+        return self.settings.get(key, default=default)
 
     def config_getbool(self, key, default=None):
-        return self._config_get(yagi.config.get_bool, key, default=default)
-
-    def _config_get(self, method, key, default=None):
-        val = None
-        if self.queue_name is not None:
-            try:
-                val = method("%s:%s" % (self.CONFIG_SECTION, self.queue_name),
-                             key)
-            except NoSectionError:
-                pass  # nothing here, try elsewhere.
-        if val is None:
-            val = method(self.CONFIG_SECTION, key, default=default)
-        return val
+        return self.settings.get_bool(key, default=default)
+
+    def config_getint(self, key, default=None):
+        return self.settings.get_int(key, default=default)
+
+    def _config_list(self, key):
+        return list(self.settings.get_list(key))
+
+    def requires(self):
+        """env keys this handler reads, from handlers earlier in the
+        chain. Used to order handlers running in parallel, see
+        yagi.handler.parallel."""
+        return self._config_list("requires")
+
+    def provides(self):
+        """env keys this handler writes results to."""
+        return (self._config_list("provides") or
+                ["%s.results" % self.__class__.__name__.lower()])
+
+    def event_type_filters(self):
+        """The (include, exclude) event type lists from the [filters] and
+        [exclude_filters] sections for this handler. Empty lists mean
+        no filtering."""
+        return routing.section_filters(self.CONFIG_SECTION)
 
     def filter_message(self, messages):
         try:
-            filter_event_type_list = []
-            exclude_filter_event_type_list = []
-            filter_event_type = yagi.config.get(
-                'filters', self.CONFIG_SECTION)
-            if filter_event_type:
-                filter_event_type_list = [a.strip() for a in filter_event_type.
-                                          split(",")]
-            exclude_filter_event_type = yagi.config.get(
-                'exclude_filters', self.CONFIG_SECTION)
-            if exclude_filter_event_type:
-                exclude_filter_event_type_list = [a.strip() for a in
-                                                  exclude_filter_event_type.
-                                                  split(",")]
-            if filter_event_type:
-                messages = [message for message in messages if message.payload[
-                            'event_type'] in filter_event_type_list]
-            if exclude_filter_event_type:
-                return [message for message in messages if message.payload[
-                        'event_type'] not in exclude_filter_event_type_list]
+            return routing.get_filter(self.CONFIG_SECTION)(messages)
         except (NoOptionError, NoSectionError):
             pass
         return messages
@@ -69,15 +83,61 @@ class BaseHandler(object):
         # Do nothing. It's ok to not implement this method.
         pass
 
+    def shutdown(self):
+        if self.app:
+            self.app.shutdown()
+        self.on_shutdown()
+
+    def on_shutdown(self):
+        # Flush anything buffered before yagi exits. It's ok to not
+        # implement this method.
+        pass
+
     def __call__(self, messages, env=None):
         if env is None:
             env = dict()
         if self.app:
             self.app(messages, env=env)
-        filtered_messages = self.filter_message(messages)
-        self.handle_messages(filtered_messages, env=env)
+        routes = env.get('yagi.routes')
+        if routes is not None and self.CONFIG_SECTION in routes:
+            filtered_messages = routes[self.CONFIG_SECTION]
+        else:
+            filtered_messages = self.filter_message(messages)
+        self.timed_handle_messages(messages, filtered_messages, env)
         return env
 
+    def timed_handle_messages(self, messages, filtered_messages, env):
+        """Runs handle_messages, recording how long it took, how many
+        messages came in and made it past the filters, and whether it
+        raised. The numbers go to statsd and to
+        env['yagi.handler_stats'][<handler name>] for later handlers."""
+        name = self.__class__.__name__.lower()
+        stats = dict(messages_in=len(messages),
+                     messages_out=len(filtered_messages),
+                     errors=0)
+        start = time.time()
+        try:
+            self.handle_messages(filtered_messages, env=env)
+        except Exception:
+            stats['errors'] = 1
+            raise
+        finally:
+            stats['elapsed'] = time.time() - start
+            env.setdefault('yagi.handler_stats', {})[name] = stats
+            self.report_stats(name, stats)
+
+    def report_stats(self, name, stats):
+        def metric(stat):
+            return yagi.stats.handler_stat(name, self.queue_name, stat)
+
+        yagi.stats.time_stat(metric("elapsed"), stats['elapsed'])
+        yagi.stats.increment_stat(metric("messages_in"),
+                                  stats['messages_in'])
+        yagi.stats.increment_stat(metric("messages_out"),
+                                  stats['messages_out'])
+        if stats['errors']:
+            yagi.stats.increment_stat(metric("errors"), stats['errors'])
+
     def filter_payload(self, payload, env):
         filters = env.get('yagi.filters')
         if filters:
@@ -86,11 +146,42 @@ class BaseHandler(object):
         return payload
 
     def iterate_payloads(self, messages, env):
+        # With batch acks the Consumer acks once the whole chain is done.
+        auto_ack = self.AUTO_ACK and not env.get('yagi.batch_ack')
         for message in messages:
             yield self.filter_payload(message.payload, env)
-            if self.AUTO_ACK and not message.acknowledged:
+            if auto_ack and not message.acknowledged:
                 message.ack()
 
+    def deliver_payloads(self, messages, env, send):
+        """Calls send(payload) with each message's filtered payload, up
+        to max_in_flight at a time. Handlers posting through a shared
+        ConnectionPool are held to max_in_flight per endpoint there (see
+        yagi.handler.http_connection). With ordered_delivery, an instance's
+        notifications are still sent one at a time, in order. See
+        yagi.handler.delivery.
+
+        AUTO_ACK messages are acked once sent, as with iterate_payloads.
+        send() may run on other threads, so whatever it records in env
+        should go into objects set up beforehand."""
+        auto_ack = self.AUTO_ACK and not env.get('yagi.batch_ack')
+
+        def send_message(message):
+            send(self.filter_payload(message.payload, env))
+
+        def done(message):
+            if auto_ack and not message.acknowledged:
+                message.ack()
+
+        lane = None
+        if self.config_getbool("ordered_delivery", default=False):
+            lane = delivery.instance_lane
+        deliver = delivery.Delivery(send_message,
+                                    self.config_getint("max_in_flight",
+                                                       default=1),
+                                    lane=lane, done=done)
+        deliver(messages)
+
     def handle_messages(self, messages, env):
         raise NotImplementedError()
 
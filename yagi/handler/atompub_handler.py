@@ -1,15 +1,15 @@
 import copy
 import logging
-import time
 import uuid
 
 import yagi.auth
 import yagi.config
 import yagi.handler
-from yagi.handler.http_connection import HttpConnection
+from yagi.handler import http_connection
 from yagi.handler.http_connection import MessageDeliveryFailed
 from yagi.handler.http_connection import UnauthorizedException
 import yagi.serializer.atom
+import yagi.shutdown
 from yagi import stats
 
 
@@ -90,77 +90,93 @@ class AtomPub(yagi.handler.BaseHandler):
         return payload_body
 
     def _send_notification(self, env, notification_payload, payload):
-        retries = int(self.config_get("retries"))
-        interval = int(self.config_get("interval"))
-        max_wait = int(self.config_get("max_wait"))
-        failures_before_reauth = int(self.config_get("failures_before_reauth"))
+        retries = self.config_getint("retries")
+        interval = self.config_getint("interval")
+        max_wait = self.config_getint("max_wait")
+        failures_before_reauth = self.config_getint("failures_before_reauth")
         endpoint = self.config_get("url")
         ah_event_id = ""
         tries = 0
         failures = 0
         code = 0
         error_msg = ''
-        connection = HttpConnection(self)
-        while True:
-            try:
-                response_details = connection.send_notification(
-                    endpoint, endpoint, notification_payload)
-                code = response_details.get("status")
-                ah_event_id = response_details.get("ah_event_id")
-                error = False
-                msg = ''
-                break
-            except UnauthorizedException, e:
-                LOG.exception(e)
-                conn = None
-                code = 401
-                error_msg = "Unauthorized"
-            except MessageDeliveryFailed, e:
-                LOG.exception(e)
-                code = e.code
-                error_msg = e.msg
-            except Exception, e:
-                code = 0 #aka 'unknown failure'
-                error_msg = "AtomPub General Delivery Failure to %s with: %s" % (
-                    endpoint, e)
-                LOG.error(error_msg)
-                LOG.exception(e)
-
-            #If we got here, something failed.
-            stats.increment_stat(yagi.stats.failure_message())
-            # Number of overall tries
-            tries += 1
-            # Number of tries between re-auth attempts
-            failures += 1
-
-            # Used primarily for testing, but it's possible we don't
-            # care if we lose messages?
-            if retries > 0:
-                if tries >= retries:
-                    msg = "Exceeded retry limit. Error %s" % error_msg
-                    self.note_result(env, payload,
-                                     code=code, message=msg)
+        delivered = False
+        pool = http_connection.get_pool(self, endpoint)
+        connection = pool.acquire(self)
+        try:
+            while True:
+                try:
+                    response_details = connection.send_notification(
+                        endpoint, endpoint, notification_payload)
+                    code = response_details.get("status")
+                    ah_event_id = response_details.get("ah_event_id")
+                    error = False
+                    msg = ''
+                    delivered = True
                     break
-            wait = min(tries * interval, max_wait)
-            LOG.error("Message delivery failed, going to sleep, will "
-                      "try again in %s seconds" % str(wait))
-            time.sleep(wait)
-
-            if failures >= failures_before_reauth:
-                # Don't always try to reconnect, give it a few
-                # tries first
-                failures = 0
-                connection = None
-            if connection is None:
-                connection = HttpConnection(self, force=True)
+                except UnauthorizedException, e:
+                    LOG.exception(e)
+                    pool.release(connection, healthy=False)
+                    connection = None
+                    code = 401
+                    error_msg = "Unauthorized"
+                except MessageDeliveryFailed, e:
+                    LOG.exception(e)
+                    code = e.code
+                    error_msg = e.msg
+                except Exception, e:
+                    code = 0 #aka 'unknown failure'
+                    error_msg = ("AtomPub General Delivery Failure to %s "
+                                 "with: %s" % (endpoint, e))
+                    LOG.error(error_msg)
+                    LOG.exception(e)
+
+                #If we got here, something failed.
+                stats.increment_stat(yagi.stats.failure_message())
+                # Number of overall tries
+                tries += 1
+                # Number of tries between re-auth attempts
+                failures += 1
+
+                # Used primarily for testing, but it's possible we don't
+                # care if we lose messages?
+                if retries > 0:
+                    if tries >= retries:
+                        msg = "Exceeded retry limit. Error %s" % error_msg
+                        self.note_result(env, payload,
+                                         code=code, message=msg)
+                        break
+                wait = min(tries * interval, max_wait)
+                LOG.error("Message delivery failed, going to sleep, will "
+                          "try again in %s seconds" % str(wait))
+                if yagi.shutdown.wait(wait):
+                    raise yagi.shutdown.ShutdownRequested(
+                        "Shutting down, abandoning delivery of %s" %
+                        payload["message_id"])
+
+                if failures >= failures_before_reauth:
+                    # Don't always try to reconnect, give it a few
+                    # tries first
+                    failures = 0
+                    if connection is not None:
+                        pool.release(connection, healthy=False)
+                    connection = None
+                if connection is None:
+                    connection = pool.acquire(self, force=True)
+        finally:
+            if connection is not None:
+                pool.release(connection, healthy=delivered)
         return code, ah_event_id
 
     def handle_messages(self, messages, env):
         entity_links = self.config_get("generate_entity_links") == "True"
         is_stacktach_down = self._to_bool(self.config_get("stacktach_down"))
         exclude_filter_list = self._exclude_filters()
+        # Set up before sending, so note_result adds to the same dict from
+        # every delivery thread.
+        env.setdefault(self.__class__.__name__.lower() + ".results", dict())
 
-        for payload in self.iterate_payloads(messages, env):
+        def send(payload):
             notification_payloads = []
             try:
                 if self._should_generate_compute_instance_verified(
@@ -175,7 +191,7 @@ class AtomPub(yagi.handler.BaseHandler):
                 LOG.error(error_msg)
                 LOG.exception(e)
                 self.note_result(env, payload, error=True, message=error_msg)
-                continue
+                return
             for notification_payload in notification_payloads:
                 code, ah_event_id = self._send_notification(env, notification_payload,
                                                payload)
@@ -185,4 +201,4 @@ class AtomPub(yagi.handler.BaseHandler):
                 else:
                     self.note_result(env, payload, code=code, service='nova')
 
-
+        self.deliver_payloads(messages, env, send)
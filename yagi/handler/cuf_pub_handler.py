@@ -1,15 +1,16 @@
 import os
-import time
 import logging
 import uuid
 from yagi import stats
 import yagi
 from yagi.config import config
-from yagi.handler.http_connection import HttpConnection, InvalidContentException
+from yagi.handler import http_connection
+from yagi.handler.http_connection import InvalidContentException
 from yagi.handler.http_connection import MessageDeliveryFailed
 from yagi.handler.http_connection import UnauthorizedException
 from yagi.handler.notification import Notification, GlanceNotification
 import yagi.serializer.cuf
+import yagi.shutdown
 
 with yagi.config.defaults_for("cufpub") as default:
     default("validate_ssl", "False")
@@ -55,20 +56,22 @@ class CufPub(yagi.handler.BaseHandler):
         return deployment_info
 
     def handle_messages(self, messages,env):
-        retries = int(self.config_get("retries"))
-        interval = int(self.config_get("interval"))
-        max_wait = int(self.config_get("max_wait"))
-        failures_before_reauth = int(self.config_get("failures_before_reauth"))
-        connection = HttpConnection(self)
+        retries = self.config_getint("retries")
+        interval = self.config_getint("interval")
+        max_wait = self.config_getint("max_wait")
+        failures_before_reauth = self.config_getint("failures_before_reauth")
+        endpoint = self.config_get("url")
+        pool = http_connection.get_pool(self, endpoint)
+        # Set up before sending, so every delivery thread adds to it.
         results = env.setdefault('cufpub.results', dict())
+        deployment_info = None
+        if messages:
+            deployment_info = self.get_deployment_info(
+                yagi.config.get('event_feed', 'atom_categories'))
 
-        for payload in self.iterate_payloads(messages, env):
+        def send(payload):
             msgid = payload["message_id"]
             try:
-                deployment_info_string = yagi.config.get('event_feed',
-                                                  'atom_categories')
-                deployment_info = self.get_deployment_info(
-                    deployment_info_string)
                 payload_body = ""
                 if "instance.exists" in payload['event_type']:
                     service = 'nova'
@@ -82,66 +85,81 @@ class CufPub(yagi.handler.BaseHandler):
                 LOG.exception(e)
                 results[msgid] = dict(error=True, code=0, message=error_msg,
                                       service=service)
-                continue
+                return
 
-            endpoint = self.config_get("url")
             tries = 0
             failures = 0
             code = 0
             ah_event_id = None
-            while True:
-                try:
-                    response_details = connection.send_notification(endpoint, endpoint,
-                                                         payload_body)
-                    code = response_details.get("status")
-                    ah_event_id = response_details.get("ah_event_id")
-                    break
-                except InvalidContentException, e:
-                    LOG.exception(e)
-                    LOG.error(payload_body)
-                    results[msgid] = dict(error=False, code=code, message=e.msg)
-                    break
-                except UnauthorizedException, e:
-                    LOG.exception(e)
-                    connection = None
-                    code = 401
-                    error_msg = "Unauthorized"
-                except MessageDeliveryFailed, e:
-                    LOG.exception(e)
-                    code = e.code
-                    error_msg = e.msg
-                except Exception, e:
-                    code = 0 #aka 'unknown failure'
-                    error_msg = "CufPub General Delivery Failure to %s with: %s" % (endpoint, e)
-                    LOG.error(error_msg)
-                    LOG.exception(e)
+            healthy = False
+            connection = pool.acquire(self)
+            try:
+                while True:
+                    try:
+                        response_details = connection.send_notification(endpoint, endpoint,
+                                                             payload_body)
+                        code = response_details.get("status")
+                        ah_event_id = response_details.get("ah_event_id")
+                        healthy = True
+                        break
+                    except InvalidContentException, e:
+                        LOG.exception(e)
+                        LOG.error(payload_body)
+                        results[msgid] = dict(error=False, code=code, message=e.msg)
+                        healthy = True
+                        break
+                    except UnauthorizedException, e:
+                        LOG.exception(e)
+                        pool.release(connection, healthy=False)
+                        connection = None
+                        code = 401
+                        error_msg = "Unauthorized"
+                    except MessageDeliveryFailed, e:
+                        LOG.exception(e)
+                        code = e.code
+                        error_msg = e.msg
+                    except Exception, e:
+                        code = 0 #aka 'unknown failure'
+                        error_msg = "CufPub General Delivery Failure to %s with: %s" % (endpoint, e)
+                        LOG.error(error_msg)
+                        LOG.exception(e)
 
-                #If we got here, something failed.
-                stats.increment_stat(yagi.stats.failure_message())
-                # Number of overall tries
-                tries += 1
-                # Number of tries between re-auth attempts
-                failures += 1
+                    #If we got here, something failed.
+                    healthy = False
+                    stats.increment_stat(yagi.stats.failure_message())
+                    # Number of overall tries
+                    tries += 1
+                    # Number of tries between re-auth attempts
+                    failures += 1
 
-                # Used primarily for testing, but it's possible we don't
-                # care if we lose messages?
-                if retries > 0:
-                    if tries >= retries:
-                        msg = "Exceeded retry limit. Error %s" % error_msg
-                        results[msgid] = dict(error=False, code=code, message=msg)
-                        break
-                wait = min(tries * interval, max_wait)
-                LOG.error("Message delivery failed, going to sleep, will "
-                         "try again in %s seconds" % str(wait))
-                time.sleep(wait)
+                    # Used primarily for testing, but it's possible we don't
+                    # care if we lose messages?
+                    if retries > 0:
+                        if tries >= retries:
+                            msg = "Exceeded retry limit. Error %s" % error_msg
+                            results[msgid] = dict(error=False, code=code, message=msg)
+                            break
+                    wait = min(tries * interval, max_wait)
+                    LOG.error("Message delivery failed, going to sleep, will "
+                             "try again in %s seconds" % str(wait))
+                    if yagi.shutdown.wait(wait):
+                        raise yagi.shutdown.ShutdownRequested(
+                            "Shutting down, abandoning delivery of %s" % msgid)
 
-                if failures >= failures_before_reauth:
-                    # Don't always try to reconnect, give it a few
-                    # tries first
-                    failures = 0
-                    connection = None
-                if connection is None:
-                    connection = HttpConnection(self,force=True)
+                    if failures >= failures_before_reauth:
+                        # Don't always try to reconnect, give it a few
+                        # tries first
+                        failures = 0
+                        if connection is not None:
+                            pool.release(connection, healthy=False)
+                        connection = None
+                    if connection is None:
+                        connection = pool.acquire(self, force=True)
+            finally:
+                if connection is not None:
+                    pool.release(connection, healthy=healthy)
 
             results[msgid] = dict(error=False, code=code, message="Success",
                                   service=service, ah_event_id=ah_event_id)
+
+        self.deliver_payloads(messages, env, send)
@@ -0,0 +1,91 @@
+import logging
+import Queue
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+
+def instance_lane(message):
+    """Lane key keeping an instance's notifications in order. Messages
+    that aren't about an instance get a lane of their own."""
+    payload = message.payload
+    try:
+        return payload['payload']['instance_id']
+    except (KeyError, TypeError):
+        return id(message)
+
+
+def build_lanes(items, lane):
+    lanes = []
+    by_key = {}
+    for item in items:
+        if lane is None:
+            lanes.append([item])
+            continue
+        key = lane(item)
+        if key not in by_key:
+            by_key[key] = []
+            lanes.append(by_key[key])
+        by_key[key].append(item)
+    return lanes
+
+
+class Delivery(object):
+    """Sends a batch, up to 'limit' items at a time.
+
+    Items with the same lane key (see instance_lane) go out one after
+    another, in batch order. Lanes are spread over up to 'limit' threads.
+    done(item) is called for every item sent, always on the calling
+    thread, so it can ack on the AMQP channel. If a send raises, no new
+    sends are started, and the first exception is raised once the ones
+    in progress are finished."""
+
+    def __init__(self, send, limit, lane=None, done=None):
+        self.send = send
+        self.limit = max(1, limit)
+        self.lane = lane
+        self.done = done or (lambda item: None)
+
+    def _run(self, lanes, sent, errors):
+        while not errors:
+            try:
+                lane = lanes.get_nowait()
+            except Queue.Empty:
+                return
+            for item in lane:
+                if errors:
+                    return
+                try:
+                    self.send(item)
+                except Exception, e:
+                    errors.append(e)
+                    return
+                sent.append(item)
+
+    def __call__(self, items):
+        if self.limit == 1 or len(items) < 2:
+            for item in items:
+                self.send(item)
+                self.done(item)
+            return
+        lanes = Queue.Queue()
+        for lane in build_lanes(items, self.lane):
+            lanes.put(lane)
+        sent = []
+        errors = []
+        threads = [threading.Thread(target=self._run,
+                                    args=(lanes, sent, errors))
+                   for n in xrange(min(self.limit, lanes.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Joining with a timeout lets the drain deadline (SIGALRM)
+            # interrupt the wait.
+            while thread.is_alive():
+                thread.join(0.1)
+        for item in sent:
+            self.done(item)
+        if errors:
+            raise errors[0]
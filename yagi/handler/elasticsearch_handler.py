@@ -53,6 +53,12 @@ class ElasticsearchHandler(yagi.handler.BaseHandler):
         dist_conf = stackdistiller.distiller.load_config(dist_conf_file)
         self.distiller = stackdistiller.distiller.Distiller(dist_conf)
 
+    def requires(self):
+        return ['cufpub.results']
+
+    def provides(self):
+        return []
+
     def _send_to_elasticsearch(self, event):
         if 'audit_period_ending' in event:
             event['@timestamp'] = event['audit_period_ending']
@@ -1,5 +1,7 @@
 import BeautifulSoup
 import logging
+import select
+import threading
 
 from yagi import http_util
 import time
@@ -11,6 +13,9 @@ import yagi.serializer.atom
 
 LOG = logging.getLogger(__name__)
 
+_pools = {}
+_pools_lock = threading.Lock()
+
 class MessageDeliveryFailed(Exception):
     def __init__(self, msg, code, *args):
         self.code = code
@@ -33,8 +38,9 @@ class InvalidContentException(Exception):
 
 class HttpConnection():
     def __init__(self, handler,force=False):
+        self.generation = yagi.config.generation
         ssl_check = not (handler.config_get("validate_ssl") == "True")
-        timeout = int(handler.config_get('timeout', default=120))
+        timeout = handler.config_getint('timeout', default=120)
         self.conn = http_util.LimitingBodyHttp(timeout=timeout,
                         disable_ssl_certificate_validation=ssl_check)
         auth_method = yagi.auth.get_auth_method()
@@ -48,11 +54,31 @@ class HttpConnection():
                 # Alternatively, if we have bad credentials, don't fill
                 # up the logs crying about it.
                 LOG.exception(e)
-                interval = int(handler.config_get("interval"))
+                interval = handler.config_getint("interval")
                 time.sleep(interval)
         else:
             raise Exception("Invalid auth or no auth supplied")
 
+    def check(self):
+        """Closes sockets the server has hung up on while they sat idle,
+        so the next request opens a new one rather than failing on it.
+        An idle keep-alive socket only turns readable once it's closed
+        (or the server sent something it shouldn't have)."""
+        for conn in self.conn.connections.values():
+            sock = conn.sock
+            if sock is None:
+                continue
+            try:
+                readable = select.select([sock], [], [], 0)[0]
+            except (select.error, ValueError, TypeError):
+                readable = True
+            if readable:
+                conn.close()
+
+    def close(self):
+        for conn in self.conn.connections.values():
+            conn.close()
+
     def send_notification(self, endpoint, puburl, body):
         LOG.info("Sending message to %s with body: %s" % (endpoint, body))
         self.headers["Content-Type"] = "application/atom+xml"
@@ -103,3 +129,136 @@ class HttpConnection():
                                                               puburl),
                        "Also, response was too large.")
                 raise MessageDeliveryFailed(msg, e.response.status)
+
+
+class ConnectionPool(object):
+    """Keeps HttpConnections to an endpoint open between notifications,
+    so a post doesn't cost a new TCP connection, TLS handshake and auth
+    call every time.
+
+    At most 'size' idle connections are kept. Connections idle for more
+    than 'max_idle' seconds, or made before the config was last reloaded,
+    are closed rather than handed out again. Connections a request failed
+    on are closed when released. Forcing a new connection (to
+    re-authenticate) closes every idle one, and keeps any in use from
+    being pooled again, as their auth is likely just as stale.
+
+    With max_in_flight set, at most that many connections are handed out
+    at once, across every thread using the pool. Acquiring waits for one
+    to be released."""
+
+    def __init__(self, size, max_idle, max_in_flight=None):
+        self.idle = []
+        self.epoch = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.configure(size, max_idle, max_in_flight)
+
+    def configure(self, size, max_idle, max_in_flight=None):
+        with self.lock:
+            self.size = size
+            self.max_idle = max_idle
+            self.max_in_flight = max_in_flight
+            self.generation = yagi.config.generation
+            self.released.notify_all()
+
+    def _take_slot(self):
+        with self.lock:
+            while (self.max_in_flight and
+                    self.in_flight >= self.max_in_flight):
+                # With a timeout, so the drain deadline (SIGALRM) can
+                # interrupt the wait.
+                self.released.wait(0.1)
+            self.in_flight += 1
+
+    def _free_slot(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.released.notify()
+
+    def _take_idle(self):
+        now = time.time()
+        stale = []
+        connection = None
+        with self.lock:
+            while self.idle:
+                # Most recently used first, it's the likeliest to still be
+                # open on the server side.
+                candidate, released = self.idle.pop()
+                if (now - released <= self.max_idle and
+                        candidate.generation == yagi.config.generation):
+                    connection = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        if connection is not None:
+            connection.check()
+        return connection
+
+    def acquire(self, handler, force=False):
+        self._take_slot()
+        try:
+            if force:
+                self.flush()
+            else:
+                connection = self._take_idle()
+                if connection is not None:
+                    return connection
+            with self.lock:
+                epoch = self.epoch
+            connection = HttpConnection(handler, force=force)
+            connection.pool_epoch = epoch
+            return connection
+        except:
+            self._free_slot()
+            raise
+
+    def release(self, connection, healthy=True):
+        try:
+            with self.lock:
+                if (healthy and connection.pool_epoch == self.epoch and
+                        len(self.idle) < self.size):
+                    self.idle.append((connection, time.time()))
+                    return
+            connection.close()
+        finally:
+            self._free_slot()
+
+    def flush(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.epoch += 1
+        for connection, released in idle:
+            connection.close()
+
+
+def get_pool(handler, endpoint):
+    """The ConnectionPool for a handler section's endpoint, shared by
+    every handler instance posting there. Sized by the pool_size,
+    pool_max_idle and max_in_flight options, which are read again once
+    the config is reloaded. As the pool is shared by every queue, these
+    come from the plain [<section>] only, never [<section>:<queue>]."""
+    key = (handler.CONFIG_SECTION, endpoint)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.generation != yagi.config.generation:
+            section = yagi.config.Settings(handler.CONFIG_SECTION)
+            settings = (section.get_int("pool_size", default=4),
+                        section.get_int("pool_max_idle", default=60),
+                        section.get_int("max_in_flight"))
+            if pool is None:
+                pool = ConnectionPool(*settings)
+                _pools[key] = pool
+            else:
+                pool.configure(*settings)
+    return pool
+
+
+def clear_pools():
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.flush()
@@ -0,0 +1,96 @@
+import logging
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+
+def build_levels(handlers):
+    """Groups handlers into levels that can run one after another, each
+    handler in a level after every earlier handler (in 'apps' order)
+    that provides an env key it requires."""
+    levels = []
+    provided = {}
+    for handler in handlers:
+        level = 0
+        for key in handler.requires():
+            if key in provided:
+                level = max(level, provided[key] + 1)
+        while len(levels) <= level:
+            levels.append([])
+        levels[level].append(handler)
+        for key in handler.provides():
+            provided[key] = max(provided.get(key, -1), level)
+    return levels
+
+
+def merge_env(env, handler_env):
+    for key, value in handler_env.iteritems():
+        current = env.get(key)
+        if value is current:
+            continue
+        if isinstance(current, dict) and isinstance(value, dict):
+            merged = dict(current)
+            merged.update(value)
+            value = merged
+        env[key] = value
+
+
+class ParallelChain(object):
+    """Stands in for the nested handler chain when a consumer has
+    'parallel_apps = True'.
+
+    Handlers declare the env keys they read (requires()) and write
+    (provides()). Handlers that don't depend on each other run at the
+    same time, each on its own thread with its own copy of env, which is
+    merged back once the whole level is done. A batch then takes as long
+    as the slowest handler, rather than all of them added up."""
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.levels = build_levels(handlers)
+        for n, level in enumerate(self.levels):
+            LOG.info("Handler level %d: %s" %
+                     (n, ", ".join(h.__class__.__name__ for h in level)))
+
+    def _run(self, handler, messages, env, errors):
+        try:
+            handler(messages, env=env)
+        except Exception, e:
+            LOG.exception("Error in %s: %s" % (handler.__class__.__name__, e))
+            errors.append(e)
+
+    def __call__(self, messages, env=None):
+        if env is None:
+            env = dict()
+        for level in self.levels:
+            if len(level) == 1:
+                level[0](messages, env=env)
+                continue
+            errors = []
+            envs = [dict(env) for handler in level]
+            threads = [threading.Thread(target=self._run,
+                                        args=(handler, messages,
+                                              handler_env, errors))
+                       for handler, handler_env in zip(level, envs)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                # Joining with a timeout lets the drain deadline (SIGALRM)
+                # interrupt the wait.
+                while thread.is_alive():
+                    thread.join(0.1)
+            for handler_env in envs:
+                merge_env(env, handler_env)
+            if errors:
+                raise errors[0]
+        return env
+
+    def idle(self, num_messages, queue_name):
+        for handler in self.handlers:
+            handler.idle(num_messages, queue_name)
+
+    def shutdown(self):
+        for handler in self.handlers:
+            handler.shutdown()
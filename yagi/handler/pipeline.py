@@ -0,0 +1,142 @@
+import logging
+import os
+import Queue
+import threading
+import time
+
+import yagi.shutdown
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """One handler in a Pipeline, with its own bounded input queue and
+    'workers' threads taking batches off it."""
+
+    def __init__(self, handler, workers, queue_size, output):
+        self.handler = handler
+        self.name = handler.__class__.__name__
+        self.workers = max(1, workers)
+        self.input = Queue.Queue(maxsize=queue_size)
+        self.output = output
+
+    def start(self):
+        for n in xrange(self.workers):
+            thread = threading.Thread(target=self.run,
+                                      name="yagi-stage-%s-%d" % (self.name,
+                                                                 n))
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while True:
+            item = self.input.get()
+            try:
+                self.process(item)
+            finally:
+                self.input.task_done()
+
+    def process(self, item):
+        kind, messages, env = item
+        if kind == "idle":
+            try:
+                self.handler.idle(*messages)
+            except Exception, e:
+                LOG.exception("Error in %s idle(): %s" % (self.name, e))
+        elif not env.get('yagi.pipeline_error'):
+            try:
+                self.handler(messages, env=env)
+            except Exception, e:
+                LOG.exception("Error in %s: %s" % (self.name, e))
+                env['yagi.pipeline_error'] = e
+        # Blocks while the next stage is full, so a slow stage holds back
+        # the ones in front of it rather than piling up batches.
+        self.output.put(item)
+
+
+class Pipeline(object):
+    """Runs a consumer's handlers as a pipeline of stages, for consumers
+    with 'pipeline = True'.
+
+    Each handler (in 'apps' order) gets its own stage, so a slow stage
+    only holds up the batches behind it, not the faster stages. Batches
+    move from stage to stage along with their env. Once the last stage is
+    done with a batch, it is queued for the consumer to ack, which has to
+    happen on the thread that owns the AMQP channel (see
+    Consumer.ack_finished). Submitting blocks while the first stage's
+    queue is full.
+
+    With several workers in a stage, batches can finish out of order.
+    Finished batches are handed back in the order they were submitted,
+    so acks go out in delivery tag order, and a multiple ack for one
+    batch never covers an earlier one still in progress."""
+
+    def __init__(self, handlers, workers, queue_size):
+        self.handlers = handlers
+        self.finished = Queue.Queue()
+        self.stages = []
+        output = self.finished
+        for handler in reversed(handlers):
+            stage = Stage(handler, workers(handler), queue_size, output)
+            self.stages.insert(0, stage)
+            output = stage.input
+        self.pid = None
+        self.submitted = 0
+        self.next_finished = 0
+        self.held = {}
+        self.held_lock = threading.Lock()
+
+    def _start(self):
+        # Threads don't survive the fork into a worker pool process, so
+        # they are started on first use, in the process that uses them.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            for stage in self.stages:
+                stage.start()
+
+    def __call__(self, messages, env=None):
+        if env is None:
+            env = dict()
+        self._start()
+        env['yagi.pipeline_batch'] = self.submitted
+        self.submitted += 1
+        self.stages[0].input.put(("batch", messages, env))
+        return env
+
+    def take_finished(self):
+        """(messages, env) for the batches through the last stage, in the
+        order they were submitted. A batch finished ahead of an earlier
+        one is held until that one is finished too. Safe to call from
+        more than one thread, each batch is only handed back once."""
+        with self.held_lock:
+            while True:
+                try:
+                    kind, messages, env = self.finished.get_nowait()
+                except Queue.Empty:
+                    break
+                if kind == "batch":
+                    self.held[env['yagi.pipeline_batch']] = (messages, env)
+            batches = []
+            while self.next_finished in self.held:
+                batches.append(self.held.pop(self.next_finished))
+                self.next_finished += 1
+            return batches
+
+    def busy(self):
+        return any(stage.input.unfinished_tasks for stage in self.stages)
+
+    def idle(self, num_messages, queue_name):
+        self._start()
+        self.stages[0].input.put(("idle", (num_messages, queue_name), None))
+
+    def shutdown(self):
+        try:
+            # Not yagi.shutdown.wait, which returns at once when shutting
+            # down, the very time this runs.
+            while self.busy():
+                time.sleep(0.1)
+        except yagi.shutdown.ShutdownRequested:
+            LOG.error("Pipeline did not finish draining in time")
+        for handler in self.handlers:
+            handler.shutdown()
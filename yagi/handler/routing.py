@@ -0,0 +1,130 @@
+"""Compiled [filters] and [exclude_filters] config.
+
+Each handler section's filters are compiled once per config generation
+(see yagi.config.generation) into an EventTypeFilter, so checking an
+event type is a set or dict lookup rather than re-reading and splitting
+the config lists for every batch. Entries may be glob patterns, such as
+compute.instance.*"""
+
+import fnmatch
+import re
+
+import yagi.config
+
+
+# Bounds the per-filter cache of event type decisions, in case some
+# publisher makes up event types on the fly.
+MAX_CACHED_EVENT_TYPES = 10000
+
+_filters = {}
+_filters_generation = None
+
+
+def event_type(message):
+    """The message's event type, without decoding the whole payload
+    when the message allows for that."""
+    try:
+        return message.event_type
+    except AttributeError:
+        return message.payload['event_type']
+
+
+def _config_list(section, key):
+    value = yagi.config.get(section, key)
+    if not value:
+        return []
+    return [a.strip() for a in value.split(",")]
+
+
+def section_filters(section):
+    """The (include, exclude) event type lists configured for a handler
+    section. Empty lists mean no filtering."""
+    return (_config_list('filters', section),
+            _config_list('exclude_filters', section))
+
+
+class EventTypeMatcher(object):
+    """Matches event types against a list of names and glob patterns."""
+
+    def __init__(self, patterns):
+        self.exact = set(p for p in patterns if not has_glob(p))
+        globs = [fnmatch.translate(p) for p in patterns if has_glob(p)]
+        self.regex = re.compile("|".join(globs)) if globs else None
+
+    def __call__(self, event_type):
+        if event_type in self.exact:
+            return True
+        return self.regex is not None and \
+               self.regex.match(event_type) is not None
+
+
+def has_glob(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+class EventTypeFilter(object):
+    def __init__(self, include, exclude):
+        self.include = EventTypeMatcher(include) if include else None
+        self.exclude = EventTypeMatcher(exclude) if exclude else None
+        self.cache = {}
+
+    @property
+    def filters(self):
+        return self.include is not None or self.exclude is not None
+
+    def accepts(self, event_type):
+        try:
+            return self.cache[event_type]
+        except KeyError:
+            pass
+        accepted = ((self.include is None or self.include(event_type)) and
+                    not (self.exclude is not None and
+                         self.exclude(event_type)))
+        if len(self.cache) < MAX_CACHED_EVENT_TYPES:
+            self.cache[event_type] = accepted
+        return accepted
+
+    def __call__(self, messages):
+        if not self.filters:
+            return messages
+        return [m for m in messages if self.accepts(event_type(m))]
+
+
+def get_filter(section):
+    """The compiled EventTypeFilter for a handler section."""
+    global _filters_generation
+    if _filters_generation != yagi.config.generation:
+        _filters.clear()
+        _filters_generation = yagi.config.generation
+    event_filter = _filters.get(section)
+    if event_filter is None:
+        event_filter = EventTypeFilter(*section_filters(section))
+        _filters[section] = event_filter
+    return event_filter
+
+
+class RoutingTable(object):
+    """Splits a batch between the handler sections of a chain, looking
+    each message's event type up once rather than once per handler."""
+
+    def __init__(self, sections):
+        self.sections = sorted(set(sections))
+
+    def route(self, messages):
+        """{section: messages that section's handlers accept}"""
+        filters = dict((s, get_filter(s)) for s in self.sections)
+        routes = {}
+        filtered = []
+        for section, event_filter in filters.iteritems():
+            if event_filter.filters:
+                routes[section] = []
+                filtered.append((section, event_filter))
+            else:
+                routes[section] = messages
+        if filtered:
+            for message in messages:
+                etype = event_type(message)
+                for section, event_filter in filtered:
+                    if event_filter.accepts(etype):
+                        routes[section].append(message)
+        return routes
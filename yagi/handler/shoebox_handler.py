@@ -70,3 +70,6 @@ class ShoeboxHandler(yagi.handler.BaseHandler):
                                     cls=notification_utils.DateTimeEncoder)
             LOG.debug("shoebox writing payload: %s" % str(payload))
             self.roll_manager.write(metadata, json_event)
+
+    def on_shutdown(self):
+        self.roll_manager.close()
@@ -28,6 +28,12 @@ class StackTachPing(yagi.handler.BaseHandler):
         result_names = self.config_get('results_from')
         return [e.strip() for e in result_names.split(',')]
 
+    def requires(self):
+        return self.results_from
+
+    def provides(self):
+        return []
+
     def match_event(self, payload):
         event_type = payload.get('event_type')
         for e in self.matching_events:
@@ -0,0 +1,66 @@
+"""Graceful shutdown for the event worker.
+
+On SIGTERM the brokers stop fetching, the batch in hand gets up to
+[event_worker] drain_timeout seconds to finish, handlers flush whatever
+they buffer, and the connections are closed. Anything left unacked is
+redelivered by RabbitMQ, rather than everything in flight."""
+
+import logging
+import signal
+import threading
+
+import yagi.config
+
+with yagi.config.defaults_for('event_worker') as default:
+    default('drain_timeout', 20)
+
+
+LOG = logging.getLogger(__name__)
+
+_requested = threading.Event()
+
+
+class ShutdownRequested(Exception):
+    """Raised to abandon work in progress when yagi is shutting down."""
+    pass
+
+
+def request():
+    _requested.set()
+
+
+def requested():
+    return _requested.is_set()
+
+
+def wait(seconds):
+    """Sleeps for up to seconds. Returns True, as soon as it happens, if
+    a shutdown is requested in the meantime."""
+    _requested.wait(seconds)
+    return _requested.is_set()
+
+
+def _deadline_passed(signum, frame):
+    raise ShutdownRequested("Drain deadline passed")
+
+
+def _terminate(signum, frame):
+    if requested():
+        return
+    timeout = int(yagi.config.get('event_worker', 'drain_timeout'))
+    LOG.info("Shutdown requested, draining for up to %d seconds" % timeout)
+    request()
+    if timeout > 0:
+        # Interrupts the main thread if the batch in hand runs long.
+        signal.signal(signal.SIGALRM, _deadline_passed)
+        signal.alarm(timeout)
+
+
+def finished():
+    """Called once drained, so the deadline can't interrupt the exit."""
+    signal.alarm(0)
+    LOG.info("Shutdown complete")
+
+
+def install():
+    signal.signal(signal.SIGTERM, _terminate)
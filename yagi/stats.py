@@ -38,6 +38,34 @@ class StatsD(object):
         return yagi.config.get("stats", "messages_sent",
                                 default="yagi.messages_sent")
 
+    def batch_size(self):
+        return yagi.config.get("stats", "batch_size",
+                                default="yagi.batch_size")
+
+    def reconnect_message(self):
+        return yagi.config.get("stats", "reconnect",
+                                default="yagi.reconnect_time")
+
+    def queue_wait(self):
+        return yagi.config.get("stats", "queue_wait",
+                                default="yagi.queue_wait")
+
+    def dedup_hits(self):
+        return yagi.config.get("stats", "dedup_hits",
+                                default="yagi.dedup_hits")
+
+    def queue_depth(self):
+        return yagi.config.get("stats", "queue_depth",
+                                default="yagi.queue_depth")
+
+    def handler_prefix(self):
+        return yagi.config.get("stats", "handler",
+                                default="yagi.handler")
+
+    def timestamp_fallbacks(self):
+        return yagi.config.get("stats", "timestamp_fallbacks",
+                                default="yagi.timestamp_fallbacks")
+
 
 class NoDriver(object):
     def ping(self, data):
@@ -52,6 +80,27 @@ class NoDriver(object):
     def messages_sent(self):
         return "messages_sent"
 
+    def batch_size(self):
+        return "batch_size"
+
+    def reconnect_message(self):
+        return "reconnect_time"
+
+    def queue_wait(self):
+        return "queue_wait"
+
+    def dedup_hits(self):
+        return "dedup_hits"
+
+    def queue_depth(self):
+        return "queue_depth"
+
+    def handler_prefix(self):
+        return "handler"
+
+    def timestamp_fallbacks(self):
+        return "timestamp_fallbacks"
+
 
 def time_stat(metric, value):
     """Format execution time."""
@@ -63,6 +112,11 @@ def increment_stat(metric, value=1):
     DRIVER.ping("%s:%s|c" % (metric, value))
 
 
+def gauge_stat(metric, value):
+    """Format gauge."""
+    DRIVER.ping("%s:%s|g" % (metric, value))
+
+
 def messages_sent():
     return DRIVER.messages_sent()
 
@@ -75,6 +129,36 @@ def failure_message():
     return DRIVER.failure_message()
 
 
+def reconnect_message():
+    return DRIVER.reconnect_message()
+
+
+def timestamp_fallbacks():
+    return DRIVER.timestamp_fallbacks()
+
+
+def batch_size(queue_name):
+    return "%s.%s" % (DRIVER.batch_size(), queue_name)
+
+
+def queue_wait(queue_name):
+    return "%s.%s" % (DRIVER.queue_wait(), queue_name)
+
+
+def dedup_hits(queue_name):
+    return "%s.%s" % (DRIVER.dedup_hits(), queue_name)
+
+
+def queue_depth(queue_name):
+    return "%s.%s" % (DRIVER.queue_depth(), queue_name)
+
+
+def handler_stat(handler_name, queue_name, stat):
+    """e.g. yagi.handler.atompub.notifications.info.elapsed"""
+    return "%s.%s.%s.%s" % (DRIVER.handler_prefix(), handler_name,
+                            queue_name or "default", stat)
+
+
 if (yagi.config.has_section("stats") and
     yagi.config.get("stats", "enabled").lower() == "true"):
     DRIVER = StatsD()